@@ -19,6 +19,17 @@ logger.addHandler(logging.StreamHandler())
 from sklearn.metrics import classification_report, roc_auc_score, accuracy_score
 
 
+def load_model(model_file):
+    """Load a booster saved in XGBoost's native format, or a pickled one from older training jobs."""
+    with open(model_file, "rb") as f:
+        raw = f.read()
+    if raw[:1] == b"\x80":  # pickle protocol 2+ header
+        return pickle.loads(raw)
+    model = xgboost.Booster()
+    model.load_model(bytearray(raw))
+    return model
+
+
 def pip_install(package):
     logger.info(f"Pip installing `{package}`")
     subprocess.call([sys.executable, "-m", "pip", "install", package])
@@ -37,7 +48,7 @@ if __name__ == "__main__":
         tar.extractall(path="..")
 
     logger.debug("Loading xgboost model.")
-    model = pickle.load(open("xgboost-model", "rb"))
+    model = load_model("xgboost-model")
 
     logger.info("Loading test input data")
     test_path = "/opt/ml/processing/test/test-dataset.csv"
@@ -0,0 +1,235 @@
+"""Local benchmark for the batch transform handler in xgboost_customer_churn.py.
+
+`decode` compares the CSV decoding in `input_fn` against the previous pandas
+based path on payloads between 1 KB and 6 MB (the batch transform mini-batch
+limit). `threads` runs a workers x nthread x batch size matrix of concurrent
+worker processes and marks the setting choose_nthread() would pick. `stream`
+compares rows/sec of the whole-body path with the chunked path
+(BATCH_STREAM_CHUNK_ROWS) and checks that both write the same output.
+`serialize` times output_fn for every format and field choice on a 100k row
+batch next to predict_fn on the same batch, with the previous per-row string
+join as the baseline.
+
+    python benchmark_batch.py
+    python benchmark_batch.py --benchmark threads --model-dir /path/to/extracted/model
+    python benchmark_batch.py --benchmark stream --chunk-rows 1000,10000
+    python benchmark_batch.py --benchmark serialize --serialize-rows 100000
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(PATH)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import load_handler, print_table, train_model
+
+DEFAULT_ROWS = os.path.join(PATH, "test_sample.csv")
+PAYLOAD_SIZES = [1 << 10, 64 << 10, 1 << 20, 6 << 20]
+SERIALIZE_ACCEPTS = [
+    "text/csv;output=probability",
+    "text/csv;output=label",
+    "text/csv;output=both;threshold=0.3;row_id=true",
+    "application/jsonlines;output=probability",
+    "application/jsonlines;output=both;row_id=true",
+    "application/x-npy;output=both;row_id=true",
+]
+
+
+def make_payload(rows_path, size):
+    """Repeat the sample rows until the body reaches roughly `size` bytes."""
+    with open(rows_path, "rb") as f:
+        lines = [line.rstrip(b"\r\n") for line in f if line.strip()]
+    body, length, i = [], 0, 0
+    while length < size:
+        line = lines[i % len(lines)]
+        body.append(line)
+        length += len(line) + 1
+        i += 1
+    return b"\n".join(body) + b"\n"
+
+
+def pandas_decode(request_body):
+    """The decoding path `input_fn` used before csv_to_array."""
+    df = pd.read_csv(StringIO(request_body.decode("utf-8")), header=None)
+    return df.values
+
+
+def time_decoder(decoder, payload, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        decoder(payload)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_decoders(handler, rows_path, sizes, repeat):
+    results = []
+    decoders = [("pandas", pandas_decode), ("csv_to_array", handler.csv_to_array)]
+    for size in sizes:
+        payload = make_payload(rows_path, size)
+        for name, decoder in decoders:
+            seconds = time_decoder(decoder, payload, repeat)
+            results.append({
+                "decoder": name,
+                "payload_kb": len(payload) // 1024,
+                "rows": payload.count(b"\n"),
+                "ms": 1000 * seconds,
+                "mb_per_sec": len(payload) / seconds / (1 << 20),
+            })
+    return results
+
+
+def _worker_throughput(handler_path, model_dir, nthread, batch, duration, barrier, queue):
+    handler = load_handler(handler_path)
+    handler.NTHREAD_OVERRIDE = str(nthread)
+    model = handler.model_fn(model_dir)
+    handler.predict_fn(batch, model)
+    barrier.wait()
+    rows, start = 0, time.perf_counter()
+    while time.perf_counter() - start < duration:
+        handler.predict_fn(batch, model)
+        rows += len(batch)
+    queue.put(rows / (time.perf_counter() - start))
+
+
+def benchmark_threads(handler, handler_path, model_dir, rows_path, workers_list, threads_list,
+                      batch_sizes, duration):
+    """Aggregate rows/sec of `workers` concurrent processes, each predicting with `nthread` threads."""
+    features = handler.csv_to_array(make_payload(rows_path, 1 << 16))
+    cores = handler.available_cores()
+    results = []
+    for batch_size in batch_sizes:
+        batch = np.ascontiguousarray(np.resize(features, (batch_size, features.shape[1])))
+        for workers in workers_list:
+            policy = handler.choose_nthread(batch_size, cores=cores, workers=workers)
+            for nthread in threads_list:
+                barrier, queue = multiprocessing.Barrier(workers), multiprocessing.Queue()
+                procs = [multiprocessing.Process(target=_worker_throughput,
+                                                 args=(handler_path, model_dir, nthread, batch, duration,
+                                                       barrier, queue))
+                         for _ in range(workers)]
+                for proc in procs:
+                    proc.start()
+                total = sum(queue.get() for _ in procs)
+                for proc in procs:
+                    proc.join()
+                results.append({
+                    "batch_size": batch_size,
+                    "workers": workers,
+                    "nthread": nthread,
+                    "rows_per_sec": total,
+                    "policy": "<-" if nthread == policy else "",
+                })
+    return results
+
+
+def benchmark_stream(handler, model_dir, rows_path, payload_sizes, chunk_rows_list, repeat):
+    """Rows/sec of the whole-body path and of each BATCH_STREAM_CHUNK_ROWS, which must score alike."""
+    model = handler.model_fn(model_dir)
+    results = []
+    for payload_size in payload_sizes:
+        payload = make_payload(rows_path, payload_size)
+        rows = payload.count(b"\n")
+        expected = None
+        for chunk_rows in [0] + chunk_rows_list:
+            handler.BATCH_STREAM_CHUNK_ROWS = chunk_rows
+            serve = lambda body: handler.output_fn(handler.predict_fn(handler.input_fn(body, "text/csv"), model),
+                                                   "text/csv")
+            output = serve(payload)
+            expected = expected if expected is not None else output
+            results.append({
+                "payload_kb": payload_size // 1024,
+                "chunk_rows": chunk_rows or "whole body",
+                "rows_per_sec": rows / time_decoder(serve, payload, repeat),
+                "same_output": output == expected,
+            })
+    return results
+
+
+def join_serialize(probabilities):
+    """The CSV encoding `output_fn` used before the vectorized serializers."""
+    return "\n".join(map(str, probabilities.tolist())).encode("utf-8")
+
+
+def benchmark_serialize(handler, model_dir, rows_path, rows, repeat):
+    model = handler.model_fn(model_dir)
+    features = handler.csv_to_array(make_payload(rows_path, 1 << 16))
+    batch = np.ascontiguousarray(np.resize(features, (rows, features.shape[1])))
+    predict_seconds = time_decoder(lambda b: handler.predict_fn(b, model), batch, repeat)
+    prediction = handler.predict_fn(batch, model)
+    probabilities = prediction["predictions"]
+
+    results = [{"accept": "predict_fn", "ms": 1000 * predict_seconds, "bytes": 0, "of_predict": 1.0}]
+    serializers = [("join (previous csv)", join_serialize, probabilities)]
+    serializers += [(accept, lambda p, accept=accept: handler.output_fn(p, accept), prediction)
+                    for accept in SERIALIZE_ACCEPTS]
+    for name, serializer, data in serializers:
+        seconds = time_decoder(serializer, data, repeat)
+        results.append({
+            "accept": name,
+            "ms": 1000 * seconds,
+            "bytes": len(serializer(data)),
+            "of_predict": seconds / predict_seconds,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--handler", type=str, default=os.path.join(PATH, "xgboost_customer_churn.py"))
+    parser.add_argument("--rows", type=str, default=DEFAULT_ROWS)
+    parser.add_argument("--benchmark", type=str, default="decode", choices=["decode", "threads", "stream", "serialize"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--model-dir", type=str, default=None,
+                        help="Directory with the extracted model artifact. A model is trained on "
+                             "2-Modeling/config/train.csv when omitted.")
+    parser.add_argument("--workers", type=str, default=None,
+                        help="Comma separated worker counts, defaults to 1, 2, 4 ... up to the core count.")
+    parser.add_argument("--threads", type=str, default=None,
+                        help="Comma separated nthread values, defaults to 1, 2, 4 ... up to the core count.")
+    parser.add_argument("--batch-sizes", type=str, default="1,100,1000,10000")
+    parser.add_argument("--duration", type=float, default=2.0, help="Seconds each matrix cell runs for.")
+    parser.add_argument("--chunk-rows", type=str, default="1000,10000",
+                        help="Comma separated BATCH_STREAM_CHUNK_ROWS values for the stream benchmark.")
+    parser.add_argument("--payload-size", type=int, default=None,
+                        help="Payload size in bytes for the stream benchmark, defaults to 1 MB and 6 MB.")
+    parser.add_argument("--serialize-rows", type=int, default=100000,
+                        help="Rows in the batch the serialize benchmark encodes.")
+    args = parser.parse_args()
+
+    handler = load_handler(args.handler)
+    if args.benchmark == "decode":
+        print_table(benchmark_decoders(handler, args.rows, PAYLOAD_SIZES, args.repeat))
+        return
+
+    model_dir = args.model_dir or train_model(os.path.join(tempfile.gettempdir(), "benchmark-model"))
+    if args.benchmark == "stream":
+        payload_sizes = [args.payload_size] if args.payload_size else PAYLOAD_SIZES[2:]
+        chunk_rows_list = [int(c) for c in args.chunk_rows.split(",")]
+        print_table(benchmark_stream(handler, model_dir, args.rows, payload_sizes, chunk_rows_list, args.repeat))
+        return
+    if args.benchmark == "serialize":
+        print_table(benchmark_serialize(handler, model_dir, args.rows, args.serialize_rows, args.repeat))
+        return
+
+    cores = handler.available_cores()
+    powers_of_two = ",".join(str(1 << i) for i in range(cores.bit_length()) if 1 << i <= cores)
+    workers_list = [int(w) for w in (args.workers or powers_of_two).split(",")]
+    threads_list = [int(t) for t in (args.threads or powers_of_two).split(",")]
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    print_table(benchmark_threads(handler, args.handler, model_dir, args.rows, workers_list, threads_list,
+                                  batch_sizes, args.duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Local benchmarks for the real-time handler in xgboost_customer_churn.py.
+
+`micro-batching` runs closed-loop clients as threads in one process, each
+sending single-row requests through input_fn -> predict_fn -> output_fn back
+to back. The table shows throughput and p50/p99 latency with micro-batching
+off and with each maximum wait. `encode` measures how many raw customer
+records per second FeatureEncoder turns into model features, next to a
+per-request pandas get_dummies encoding with the same schema.
+
+    python benchmark_realtime.py --concurrency 1,8,32 --max-wait-us 100,500,2000
+    python benchmark_realtime.py --benchmark encode --batch-sizes 1,100,10000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(PATH)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import load_handler, load_script, print_table, read_rows, train_model
+
+DEFAULT_ROWS = os.path.join(PATH, "test_sample.csv")
+PREPROCESS_SCRIPT = os.path.join(REPO_ROOT, "6-Pipelines", "config", "preprocess.py")
+
+
+def run_load(handler, model, rows, concurrency, duration):
+    """Run `concurrency` closed-loop clients for `duration` seconds and collect request latencies."""
+    latencies = [[] for _ in range(concurrency)]
+    stop = threading.Event()
+
+    def client(i):
+        n = i
+        while not stop.is_set():
+            payload = rows[n % len(rows)]
+            start = time.perf_counter()
+            data = handler.input_fn(payload, "text/csv")
+            handler.output_fn(handler.predict_fn(data, model), "text/csv")
+            latencies[i].append(time.perf_counter() - start)
+            n += concurrency
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return np.concatenate([np.array(client_latencies) for client_latencies in latencies]), elapsed
+
+
+def benchmark_micro_batching(handler, model_dir, rows, concurrency_levels, max_waits, max_batch_size, duration):
+    # One model and one batcher for every run: each model_fn would start another batcher thread that
+    # outlives its run. The batcher reads its limits per batch, so they can change between runs
+    handler.MICRO_BATCH_MAX_SIZE = max_batch_size
+    model = handler.model_fn(model_dir)
+    batcher = model.micro_batcher
+    results = []
+    for concurrency in concurrency_levels:
+        for max_wait_us in [None] + max_waits:
+            if max_wait_us is not None:
+                batcher.max_wait = max_wait_us / 1e6
+            model.micro_batcher = None if max_wait_us is None else batcher
+            latencies, elapsed = run_load(handler, model, rows, concurrency, duration)
+            results.append({
+                "concurrency": concurrency,
+                "max_wait_us": "off" if max_wait_us is None else max_wait_us,
+                "requests_per_sec": len(latencies) / elapsed,
+                "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+                "p99_ms": 1000 * float(np.percentile(latencies, 99)),
+            })
+    return results
+
+
+def load_schema(schema_path=None):
+    """Read an encoding schema file, or build one with the pipeline's preprocessing script."""
+    if schema_path is not None:
+        with open(schema_path) as f:
+            return json.load(f)
+    return load_script(PREPROCESS_SCRIPT, "preprocess").build_encoding_schema()
+
+
+def make_records(schema, count, seed=0):
+    """Random raw customer records with every field the schema encodes."""
+    rng = np.random.default_rng(seed)
+    columns = {name: rng.integers(0, 300, count).tolist() for name in schema["numeric"]}
+    for name, values in schema["categorical"].items():
+        columns[name] = [values[i] for i in rng.integers(0, len(values), count)]
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def pandas_encode(schema, records):
+    """Encode records with pd.get_dummies against the schema's vocabularies."""
+    df = pd.DataFrame(records)
+    for name, values in schema["categorical"].items():
+        df[name] = pd.Categorical(df[name].astype(str), categories=values)
+    return pd.get_dummies(df, dtype=np.float32)[schema["columns"]].values
+
+
+def benchmark_encoding(handler, schema, batch_sizes, repeat):
+    encoder = handler.FeatureEncoder(schema)
+    encoders = [("pandas get_dummies", lambda records: pandas_encode(schema, records)),
+                ("FeatureEncoder", encoder.encode)]
+    results = []
+    for batch_size in batch_sizes:
+        records = make_records(schema, batch_size)
+        expected = pandas_encode(schema, records)
+        for name, encode in encoders:
+            assert np.array_equal(encode(records), expected)
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                encode(records)
+                best = min(best, time.perf_counter() - start)
+            results.append({
+                "encoder": name,
+                "batch_size": batch_size,
+                "us_per_batch": 1e6 * best,
+                "records_per_sec": batch_size / best,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--handler", type=str, default=os.path.join(PATH, "xgboost_customer_churn.py"))
+    parser.add_argument("--benchmark", type=str, default="micro-batching", choices=["micro-batching", "encode"])
+    parser.add_argument("--model-dir", type=str, default=None,
+                        help="Directory with the extracted model artifact. A model is trained on "
+                             "2-Modeling/config/train.csv when omitted.")
+    parser.add_argument("--rows", type=str, default=DEFAULT_ROWS)
+    parser.add_argument("--concurrency", type=str, default="1,8,32")
+    parser.add_argument("--max-wait-us", type=str, default="100,500,2000")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds each configuration runs for.")
+    parser.add_argument("--schema", type=str, default=None,
+                        help="Encoding schema file, built with 6-Pipelines/config/preprocess.py when omitted.")
+    parser.add_argument("--batch-sizes", type=str, default="1,100,10000")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.benchmark == "encode":
+        batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+        print_table(benchmark_encoding(load_handler(args.handler), load_schema(args.schema), batch_sizes,
+                                       args.repeat))
+        return
+
+    model_dir = args.model_dir or train_model(os.path.join(tempfile.gettempdir(), "benchmark-model"))
+    handler = load_handler(args.handler)
+    rows = read_rows(args.rows)
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    max_waits = [int(w) for w in args.max_wait_us.split(",")]
+
+    print_table(benchmark_micro_batching(handler, model_dir, rows, concurrency_levels, max_waits,
+                                         args.max_batch_size, args.duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,7 +29,8 @@ logger.setLevel(logging.CRITICAL)
 
 PATH = os.path.dirname(__file__)
 
-def get_estimator_from_lab2(docker_image_name, framework_version):
+def get_estimator_from_lab2(docker_image_name, framework_version, instance_count=1, checkpoint_frequency=0,
+                            early_stopping_rounds=0):
     print("Getting solution from Lab 2...")
     print("Please wait 5 minutes for the training job to run.")
     
@@ -78,6 +79,8 @@ def get_estimator_from_lab2(docker_image_name, framework_version):
                                                   description="Using xgboost to predict customer churn", 
                                                   sagemaker_boto_client=boto3.client('sagemaker'))
 
+    # The script also takes "tree_method" (e.g. "hist", trained on a QuantileDMatrix) and "max_bin";
+    # unset, XGBoost's default tree method is used as in the lab
     hyperparams = {"max_depth":5,
                    "subsample":0.8,
                    "num_round":600,
@@ -88,6 +91,19 @@ def get_estimator_from_lab2(docker_image_name, framework_version):
                    "verbosity": 0
                   }
 
+    # Early stopping on the validation set is opt-in: it needs XGBoost 1.4 or later (framework_version
+    # 1.5-1 or later)
+    if early_stopping_rounds > 0:
+        hyperparams["early_stopping_rounds"] = early_stopping_rounds
+
+    # Round checkpoints are opt-in: they need XGBoost 1.6 or later (framework_version 1.7-1 or later).
+    # Each job checkpoints under its own name, so it never resumes another job's model
+    job_name = f'demo-xgboost-customer-churn-{create_date()}'
+    checkpoint_s3_uri = None
+    if checkpoint_frequency > 0:
+        hyperparams["checkpoint_frequency"] = checkpoint_frequency
+        checkpoint_s3_uri = f's3://{bucket}/{prefix}/checkpoints/{job_name}'
+
     
     entry_point_script = f'{PATH}/xgboost_customer_churn.py'
     trial = Trial.create(trial_name=f'framework-mode-trial-{create_date()}', 
@@ -106,9 +122,10 @@ def get_estimator_from_lab2(docker_image_name, framework_version):
                             framework_version=framework_version,
                             py_version="py3",
                             hyperparameters=hyperparams,
-                            instance_count=1, 
+                            instance_count=instance_count, 
                             instance_type='ml.m4.xlarge',
                             output_path=f's3://{bucket}/{prefix}/output',
+                            checkpoint_s3_uri=checkpoint_s3_uri,
                             base_job_name='demo-xgboost-customer-churn',
                             sagemaker_session=sm_sess,
                             rules=debug_rules
@@ -119,6 +136,7 @@ def get_estimator_from_lab2(docker_image_name, framework_version):
                           'train': s3_input_train,
                           'validation': s3_input_validation
                              },
+                      job_name=job_name,
                       experiment_config={
                           'ExperimentName': customer_churn_experiment.experiment_name, 
                           'TrialName': trial.trial_name,
@@ -1,15 +1,148 @@
 import argparse
+import atexit
+import hashlib
 import json
+import math
 import os
 import pickle
+import queue
 import random
+import shutil
+import socket
+import sys
+import tarfile
 import tempfile
+import threading
+import time
 import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+from itertools import islice
+from operator import itemgetter
 
+import numpy as np
 import xgboost
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    # The XGBoost container's own decoders, which libsvm bodies are left to
+    import sagemaker_xgboost_container.encoder as xgb_encoders
+except ImportError:
+    xgb_encoders = None
 from smdebug import SaveConfig
 from smdebug.xgboost import Hook
 
+# Width of the feature vector produced by the data preparation lab (label excluded)
+NUM_FEATURES = 69
+
+MODEL_FILE_NAME = "xgboost-model"
+
+# Feature encoding schema written by the preprocessing step and shipped next to the model
+ENCODING_SCHEMA_FILE = "encoding-schema.json"
+ENCODING_SCHEMA_VERSION = 1
+
+# Channel files with this suffix are read as Parquet, everything else as headerless CSV
+PARQUET_SUFFIX = ".parquet"
+
+# xgboost.DataIter, which external-memory training builds on, only exists from XGBoost 1.5
+_DataIter = getattr(xgboost, "DataIter", object)
+
+# Tree methods that split on histogram bins and honour max_bin
+BINNED_TREE_METHODS = ["hist", "approx"]
+# Rows per batch when a channel is loaded in memory through ChannelBatches: for the quantile sketch
+# of "hist", and for the shard of a channel each worker of a distributed job reads
+MEMORY_BATCH_ROWS = 100000
+
+# xgboost.callback.TrainingCallback, which the training callbacks build on, only exists from XGBoost 1.3
+_TrainingCallback = getattr(xgboost.callback, "TrainingCallback", object)
+
+# Checkpoints are named after the rounds they hold: checkpoint-000120.ubj
+CHECKPOINT_PREFIX = "checkpoint-"
+CHECKPOINT_SUFFIX = ".ubj"
+# Booster attribute that records what a checkpoint was trained on (see checkpoint_fingerprint)
+CHECKPOINT_FINGERPRINT_ATTR = "checkpoint_fingerprint"
+# Checkpoints are UBJSON, which XGBoost reads and writes from 1.6 on; early stopping and warm starts
+# count rounds with num_boosted_rounds, and early stopping exports a model slice, which need 1.4;
+# distributed training uses the collective API and RabitTracker of 2.1
+XGBOOST_VERSION = tuple(int(part) for part in xgboost.__version__.split(".")[:2])
+
+# Best round and score of an early-stopped job, written next to the model
+BEST_ITERATION_FILE = "best-iteration.json"
+# Training job, checksum and rounds of the model and of the models it was warm started from
+LINEAGE_FILE = "lineage.json"
+# Evaluation metrics that improve upwards; early stopping minimizes every other one
+MAXIMIZE_METRICS = ["auc", "aucpr", "map", "ndcg", "pre"]
+
+# Pickle protocol 2+ streams start with this opcode; native XGBoost formats never do
+_PICKLE_HEADER = b"\x80"
+
+# Set MODEL_WARMUP=false to skip the load-time warm-up prediction
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "true").lower() == "true"
+
+# Threading policy: XGBOOST_NTHREAD pins the thread count; otherwise the cores are split across the
+# model server workers and small requests stay single threaded
+NTHREAD_OVERRIDE = os.environ.get("XGBOOST_NTHREAD")
+MIN_ROWS_PER_THREAD = int(os.environ.get("XGBOOST_MIN_ROWS_PER_THREAD", 256))
+# Per-thread copy of the served booster that predict_array scores requests of another thread count with
+_THREAD_BOOSTERS = threading.local()
+
+# numpy >= 1.23 parses text in C; older releases fall back to a single flat `fromstring` pass
+_C_LOADTXT = np.lib.NumpyVersion(np.__version__) >= "1.23.0"
+_CSV_LINE_BREAKS = bytes.maketrans(b"\r\n", b" ,")
+
+# "inplace" skips building a DMatrix per request; set PREDICT_MODE=dmatrix to force the DMatrix path
+PREDICT_MODE = os.environ.get("PREDICT_MODE", "inplace")
+
+CSV_CONTENT_TYPE = "text/csv"
+NPY_CONTENT_TYPE = "application/x-npy"
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+JSONLINES_CONTENT_TYPE = "application/jsonlines"
+JSON_CONTENT_TYPE = "application/json"
+LIBSVM_CONTENT_TYPE = "text/libsvm"
+
+# Fields output_fn returns unless the Accept header asks otherwise: probability, label or both
+DEFAULT_OUTPUT = os.environ.get("PREDICTION_OUTPUT", "probability")
+DEFAULT_THRESHOLD = float(os.environ.get("PREDICTION_THRESHOLD", 0.5))
+# Digits after the decimal point when probabilities are written as text
+PROBABILITY_DECIMALS = 6
+# An Accept value without parameters gets the response written before they could be given: the
+# default field as str() of each value, one per line, for CSV, and for JSON a bare list of them
+PLAIN_JSON_KEY = None
+
+# Opt-in cache of per-row predictions: PREDICTION_CACHE_SIZE rows (0 disables it), entries expire
+# after PREDICTION_CACHE_TTL seconds (0 keeps them until evicted). Hits, misses and evictions are
+# emitted with the stage metrics
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 0))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", 0))
+
+# Opt-in micro-batching of concurrent requests: up to MICRO_BATCH_MAX_SIZE rows per booster call
+# (0 disables it), waiting at most MICRO_BATCH_MAX_WAIT_US microseconds for a batch to fill
+MICRO_BATCH_MAX_SIZE = int(os.environ.get("MICRO_BATCH_MAX_SIZE", 0))
+MICRO_BATCH_MAX_WAIT_US = int(os.environ.get("MICRO_BATCH_MAX_WAIT_US", 500))
+
+# Per-stage latency, batch size and payload size histograms, flushed every METRICS_FLUSH_SECONDS as
+# CloudWatch Embedded Metric Format log lines (0 turns the instrumentation off)
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 60))
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SageMakerWorkshop/Inference")
+# The most values CloudWatch accepts in one EMF metric value array
+MAX_EMF_VALUES = 100
+
+# On-demand sampling profiler. PROFILE_SECONDS or PROFILE_REQUESTS profile each worker from start-up,
+# model_fn included. With PROFILE_ON_REQUEST=true, a request whose Content-Type carries "profile=<n>"
+# or "profile=<n>s" starts a run over the next n requests or seconds; otherwise the parameter is
+# ignored. Collapsed stacks are written to PROFILE_DIR, or the model directory when it is unset
+PROFILE_ON_REQUEST = os.environ.get("PROFILE_ON_REQUEST", "false").lower() == "true"
+PROFILE_SECONDS = float(os.environ.get("PROFILE_SECONDS", 0))
+PROFILE_REQUESTS = int(os.environ.get("PROFILE_REQUESTS", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
 
 def parse_args():
 
@@ -23,15 +156,54 @@ def parse_args():
     parser.add_argument("--verbosity", type=int, default=0)
     parser.add_argument("--objective", type=str, default="binary:logistic")
     parser.add_argument("--num_round", type=int, default=50)
+    parser.add_argument("--tree_method", type=str, default=None,
+                        help="XGBoost tree_method; hist trains on a QuantileDMatrix. Unset keeps XGBoost's default.")
+    parser.add_argument("--max_bin", type=int, default=256)
+    parser.add_argument("--nthread", type=int, default=0,
+                        help="Training threads; 0 uses every core.")
+    parser.add_argument("--eval_metric", type=str, default=None,
+                        help="Evaluation metric, the objective's default (logloss) if unset.")
+    parser.add_argument("--early_stopping_rounds", type=int, default=0,
+                        help="Stop once the validation metric has not improved for this many rounds; "
+                             "0 trains all --num_round rounds.")
+    parser.add_argument("--metrics_mode", type=str, choices=["smdebug", "callback", "none"], default="smdebug",
+                        help="Record training metrics with the smdebug hook, with the asynchronous metrics "
+                             "callback, or not at all.")
+    parser.add_argument("--metrics_path", type=str,
+                        default=os.path.join(os.environ.get("SM_OUTPUT_DATA_DIR", "/opt/ml/output/data"),
+                                             "metrics.jsonl"),
+                        help="JSON Lines file the metrics callback appends to.")
+    parser.add_argument("--metrics_batch_rounds", type=int, default=10,
+                        help="Rounds of metrics the callback hands to its writer thread at a time.")
     parser.add_argument("--smdebug_path", type=str, default=None)
     parser.add_argument("--smdebug_frequency", type=int, default=1)
     parser.add_argument("--smdebug_collections", type=str, default='metrics')
+    parser.add_argument("--external_memory_batch_rows", type=int, default=0,
+                        help="Stream the channels into an external-memory DMatrix this many rows at a time; "
+                             "0 loads them in memory.")
+    parser.add_argument("--external_memory_dir", type=str, default=None,
+                        help="Local directory for the external-memory page cache, the temp directory if unset.")
+    parser.add_argument("--checkpoint_frequency", type=int, default=0,
+                        help="Save a checkpoint every this many rounds and resume from the newest one; 0 disables.")
+    parser.add_argument("--checkpoint_keep", type=int, default=3,
+                        help="Number of newest checkpoints kept.")
+    parser.add_argument("--checkpoint_dir", type=str, default="/opt/ml/checkpoints",
+                        help="Local checkpoint directory; SageMaker syncs it with the job's checkpoint_s3_uri.")
+    parser.add_argument("--tracker_port", type=int, default=9099,
+                        help="Port of the collective tracker the first host runs in distributed jobs.")
     parser.add_argument("--output_uri", type=str, default="/opt/ml/output/tensors",
                         help="S3 URI of the bucket where tensor data will be stored.")
 
     parser.add_argument('--train', type=str, default=os.environ.get('SM_CHANNEL_TRAIN'))
     parser.add_argument('--validation', type=str, default=os.environ.get('SM_CHANNEL_VALIDATION'))
+    parser.add_argument('--schema', type=str, default=os.environ.get('SM_CHANNEL_SCHEMA'))
+    parser.add_argument('--base_model', type=str, default=os.environ.get('SM_CHANNEL_BASE_MODEL'))
+    parser.add_argument("--warm_start_rounds", type=int, default=10,
+                        help="Rounds added to the model of the base_model channel, if given, instead of "
+                             "training --num_round rounds from scratch.")
     parser.add_argument('--model-dir', type=str, default=os.environ['SM_MODEL_DIR'])
+    parser.add_argument('--hosts', type=json.loads, default=os.environ.get('SM_HOSTS', '["localhost"]'))
+    parser.add_argument('--current-host', type=str, default=os.environ.get('SM_CURRENT_HOST', 'localhost'))
     
     args = parser.parse_args()
 
@@ -52,14 +224,475 @@ def create_smdebug_hook(out_dir, train_data=None, validation_data=None, frequenc
     return hook
 
 
+def load_channel(channel_dir, shard=None):
+    """
+    DMatrix of a data channel, label in the first column. Channels of Parquet files written by
+    preprocess.py --output-format parquet are read column by column, without parsing text;
+    anything else is read as headerless CSV. A `shard` reads only this worker's part of the
+    channel, see ChannelBatches.
+    """
+    if shard is not None:
+        return xgboost.DMatrix(ChannelBatches(channel_dir, MEMORY_BATCH_ROWS, None, shard=shard))
+    parquet_files = sorted(os.path.join(channel_dir, file) for file in os.listdir(channel_dir)
+                           if file.endswith(PARQUET_SUFFIX))
+    if not parquet_files:
+        return xgboost.DMatrix(channel_dir + "?format=csv&label_column=0")
+    if pq is None:
+        raise ImportError("pyarrow is required to train on Parquet data in {}".format(channel_dir))
+
+    table = pa.concat_tables(pq.read_table(file) for file in parquet_files)
+    features, label = parquet_features(table)
+    del table
+    return xgboost.DMatrix(features, label=label)
+
+
+class AsyncMetricsCallback(_TrainingCallback):
+    """
+    Lightweight alternative to the smdebug hook. The evaluation metrics of every round are
+    collected in memory and handed to a background thread `batch_rounds` rounds at a time, which
+    appends them to a JSON Lines file. Boosting never waits on the file, and every round is
+    written by the time training returns.
+    """
+
+    def __init__(self, path, batch_rounds=10):
+        self.path = path
+        self.batch_rounds = batch_rounds
+        self._pending = []
+        self._queue = queue.Queue()
+        self._writer = None
+        super().__init__()
+
+    def _write(self):
+        with open(self.path, "a") as f:
+            for batch in iter(self._queue.get, None):
+                f.write("".join(json.dumps(record) + "\n" for record in batch))
+                f.flush()
+
+    def before_training(self, model):
+        if self._writer is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._writer = threading.Thread(target=self._write, name="metrics-writer", daemon=True)
+            self._writer.start()
+        return model
+
+    def after_iteration(self, model, epoch, evals_log):
+        # epoch restarts at 0 in every checkpoint segment, the booster's round count does not. XGBoost
+        # before 1.4 has no num_boosted_rounds, but then neither checkpoints nor warm starts run and
+        # epoch is the round
+        rounds = model.num_boosted_rounds() if hasattr(model, "num_boosted_rounds") else epoch + 1
+        record = {"round": rounds - 1, "timestamp": time.time()}
+        for data_name, metrics in evals_log.items():
+            for metric_name, values in metrics.items():
+                record["{}-{}".format(data_name, metric_name)] = float(values[-1])
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_rounds:
+            self._queue.put(self._pending)
+            self._pending = []
+        return False
+
+    def after_training(self, model):
+        if self._pending:
+            self._queue.put(self._pending)
+            self._pending = []
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        return model
+
+
+class EarlyStoppingCallback(_TrainingCallback):
+    """
+    Stop training once the last metric of the `data_name` evaluation set has not improved for
+    `rounds` rounds. Like xgboost.train's early_stopping_rounds, the best round and score are kept
+    in the booster attributes best_iteration and best_score, but the callback keeps no state of its
+    own, so the count carries over checkpoint segments and resumed jobs unchanged.
+    """
+
+    def __init__(self, rounds, data_name="validation"):
+        self.rounds = rounds
+        self.data_name = data_name
+        super().__init__()
+
+    def after_iteration(self, model, epoch, evals_log):
+        metric, values = list(evals_log[self.data_name].items())[-1]
+        score = float(values[-1])
+        iteration = model.num_boosted_rounds() - 1
+        best_score = model.attr("best_score")
+        if best_score is None:
+            improved = True
+        elif any(metric.startswith(name) for name in MAXIMIZE_METRICS):
+            improved = score > float(best_score)
+        else:
+            improved = score < float(best_score)
+        if improved:
+            model.set_attr(best_score=repr(score), best_iteration=str(iteration),
+                           best_metric="{}-{}".format(self.data_name, metric))
+        return not improved and iteration - int(model.attr("best_iteration")) >= self.rounds
+
+
+def parquet_features(table):
+    """Float32 feature matrix and label vector of an Arrow table or record batch, label in the first column."""
+    label = table.column(0).to_numpy()
+    columns = [column.to_numpy() for column in table.columns[1:]]
+    features = np.empty((table.num_rows, len(columns)), dtype=np.float32)
+    # Transpose a few thousand rows at a time: writing whole columns into the row-major matrix
+    # strides through memory and takes about ten times longer
+    block = 4096
+    for start in range(0, table.num_rows, block):
+        features[start:start + block] = np.vstack([column[start:start + block] for column in columns]).T
+    return features, label
+
+
+class ChannelBatches(_DataIter):
+    """
+    Feed the CSV or Parquet files of a channel to XGBoost `batch_rows` rows at a time. XGBoost
+    pages every batch out to a cache under `cache_prefix`, so building the external-memory
+    DMatrix only ever holds one batch in memory. With `keep_batches` the parsed batches are
+    kept after the first pass, so the several passes a QuantileDMatrix makes over its input
+    parse every file once.
+
+    A `shard` of (rank, world_size) makes the iterator feed only one worker's part of the
+    channel: every world_size-th file when there are at least as many files as workers,
+    otherwise every world_size-th row of every file.
+    """
+
+    def __init__(self, channel_dir, batch_rows, cache_prefix, keep_batches=False, shard=None):
+        self.files = sorted(os.path.join(channel_dir, file) for file in os.listdir(channel_dir)
+                            if not file.startswith("."))
+        if any(file.endswith(PARQUET_SUFFIX) for file in self.files) and pq is None:
+            raise ImportError("pyarrow is required to train on Parquet data in {}".format(channel_dir))
+        if shard is not None and len(self.files) >= shard[1]:
+            self.files = self.files[shard[0]::shard[1]]
+            shard = None
+        self.row_shard = shard
+        self.batch_rows = batch_rows
+        self._batches = None
+        self._kept = [] if keep_batches else None
+        self._kept_all = False
+        super().__init__(cache_prefix=cache_prefix)
+
+    def _read_batches(self):
+        if self.row_shard is None:
+            yield from self._parse_files()
+            return
+        rank, world_size = self.row_shard
+        offset = 0
+        for features, label in self._parse_files():
+            # Keep the rows whose index in the whole channel is rank modulo world_size
+            start = (rank - offset) % world_size
+            offset += len(label)
+            yield features[start::world_size], label[start::world_size]
+
+    def _parse_files(self):
+        for file in self.files:
+            if file.endswith(PARQUET_SUFFIX):
+                for batch in pq.ParquetFile(file).iter_batches(batch_size=self.batch_rows):
+                    yield parquet_features(batch)
+                continue
+            with open(file) as f:
+                while True:
+                    lines = list(islice(f, self.batch_rows))
+                    if not lines:
+                        break
+                    data = np.loadtxt(lines, delimiter=",", dtype=np.float32, ndmin=2)
+                    yield data[:, 1:], data[:, 0]
+
+    def next(self, input_data):
+        batch = next(self._batches, None)
+        if batch is None:
+            self._kept_all = self._kept is not None
+            return 0
+        if self._kept is not None and not self._kept_all:
+            self._kept.append(batch)
+        features, label = batch
+        input_data(data=features, label=label)
+        return 1
+
+    def reset(self):
+        self._batches = iter(self._kept) if self._kept_all else self._read_batches()
+
+
+def load_channel_external(channel_dir, batch_rows, cache_dir, shard=None):
+    """External-memory DMatrix of a data channel, streamed `batch_rows` rows at a time."""
+    if _DataIter is object:
+        raise RuntimeError("External-memory training needs XGBoost 1.5 or later, found {}".format(
+            xgboost.__version__))
+    name = os.path.basename(os.path.normpath(channel_dir))
+    return xgboost.DMatrix(ChannelBatches(channel_dir, batch_rows, os.path.join(cache_dir, name), shard=shard))
+
+
+def load_channel_quantile(channel_dir, batch_rows, max_bin, ref=None, cache_dir=None, shard=None):
+    """
+    Quantized DMatrix of a data channel for the hist tree method. The channel is sketched and
+    binned batch by batch, and the matrix keeps 1-byte bin indices instead of float values.
+    The parsed batches are released once the matrix is built; with a `cache_dir` they are not
+    kept at all and the bins are paged out to disk too, on XGBoost 3.0 or later. Validation data
+    passes the training matrix as `ref` so both use the same bin boundaries.
+    """
+    if cache_dir is None:
+        batches = ChannelBatches(channel_dir, batch_rows, None, keep_batches=True, shard=shard)
+        return xgboost.QuantileDMatrix(batches, max_bin=max_bin, ref=ref)
+    name = os.path.basename(os.path.normpath(channel_dir))
+    batches = ChannelBatches(channel_dir, batch_rows, os.path.join(cache_dir, name), shard=shard)
+    if not hasattr(xgboost, "ExtMemQuantileDMatrix"):
+        return xgboost.DMatrix(batches)
+    return xgboost.ExtMemQuantileDMatrix(batches, max_bin=max_bin, ref=ref)
+
+
+def checkpoint_path(checkpoint_dir, rounds):
+    return os.path.join(checkpoint_dir, "{}{:06d}{}".format(CHECKPOINT_PREFIX, rounds, CHECKPOINT_SUFFIX))
+
+
+def list_checkpoints(checkpoint_dir):
+    """(rounds, path) of every checkpoint in `checkpoint_dir`, newest first."""
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    checkpoints = []
+    for file in os.listdir(checkpoint_dir):
+        rounds = file[len(CHECKPOINT_PREFIX):-len(CHECKPOINT_SUFFIX)]
+        if file.startswith(CHECKPOINT_PREFIX) and file.endswith(CHECKPOINT_SUFFIX) and rounds.isdigit():
+            checkpoints.append((int(rounds), os.path.join(checkpoint_dir, file)))
+    return sorted(checkpoints, reverse=True)
+
+
+def checkpoint_fingerprint(params, channel_dirs, parent=None):
+    """
+    Hash of what the checkpoints of a job depend on: the hyperparameters but nthread, the names and
+    sizes of the channel files, and the checksum of the base model, if any.
+    """
+    files = []
+    for channel_dir in channel_dirs:
+        for file in sorted(os.listdir(channel_dir)):
+            if os.path.isfile(os.path.join(channel_dir, file)):
+                files.append([file, os.path.getsize(os.path.join(channel_dir, file))])
+    record = {
+        "params": {name: value for name, value in params.items() if name != "nthread"},
+        "files": files,
+        "parent": parent["model_sha256"] if parent else None,
+    }
+    return hashlib.sha256(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_latest_checkpoint(checkpoint_dir, fingerprint=None):
+    """
+    The newest checkpoint that loads and holds as many rounds as its name says, with that number
+    of rounds, or (None, 0) if there is none. Damaged checkpoints are skipped. A checkpoint with
+    another `fingerprint` is an error: resuming it would return a model of other inputs.
+    """
+    for rounds, path in list_checkpoints(checkpoint_dir):
+        booster = xgboost.Booster()
+        try:
+            booster.load_model(path)
+        except xgboost.core.XGBoostError:
+            booster = None
+        if booster is not None and booster.num_boosted_rounds() == rounds:
+            if fingerprint is not None and booster.attr(CHECKPOINT_FINGERPRINT_ATTR) != fingerprint:
+                raise ValueError("Checkpoint {} was trained on other hyperparameters or data; give every "
+                                 "training job its own checkpoint_s3_uri".format(path))
+            return booster, rounds
+        print("Skipping damaged checkpoint {}".format(path))
+    return None, 0
+
+
+def save_checkpoint(booster, checkpoint_dir, rounds, keep):
+    """
+    Save `booster` as the checkpoint of `rounds` rounds. The bytes go to a temporary file that is
+    flushed to disk and then renamed over the final name, so a checkpoint is either complete or
+    absent. Only the newest `keep` checkpoints are kept.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=checkpoint_dir, prefix=".tmp-", delete=False) as f:
+        f.write(booster.save_raw("ubj"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, checkpoint_path(checkpoint_dir, rounds))
+    for _, path in list_checkpoints(checkpoint_dir)[keep:]:
+        os.remove(path)
+
+
+def train_with_checkpoints(params, dtrain, num_round, evals, callbacks, checkpoint_dir, frequency, keep,
+                           early_stopping_rounds=0, base_model=None, write=True, fingerprint=None):
+    """
+    Run xgboost.train in segments of `frequency` rounds and checkpoint after each one, starting
+    from the newest valid checkpoint in `checkpoint_dir`. Every segment starts from a booster
+    loaded from checkpoint bytes and seeds the row and column samplers with the seed plus the
+    rounds done, so an interrupted and resumed job ends with exactly the model an uninterrupted
+    one does. A segment cut short by EarlyStoppingCallback, or a checkpoint that is already
+    `early_stopping_rounds` past its best round, ends training. Without a checkpoint, training
+    starts from `base_model` if given. `write` is False on the workers of a distributed job that
+    are not the leader; the leader stores `fingerprint` in its checkpoints and checks it on resume.
+    """
+    bst, rounds = load_latest_checkpoint(checkpoint_dir, fingerprint if write else None)
+    if rounds:
+        print("Resuming training from the checkpoint of round {}".format(rounds))
+    elif base_model is not None:
+        bst, rounds = base_model, base_model.num_boosted_rounds()
+    seed = params.get("seed", 0)
+    while rounds < num_round:
+        if early_stopping_rounds and bst is not None and bst.attr("best_iteration") is not None \
+                and rounds - 1 - int(bst.attr("best_iteration")) >= early_stopping_rounds:
+            break
+        segment = min(frequency, num_round - rounds)
+        bst = xgboost.train(
+            params=dict(params, seed=seed + rounds),
+            dtrain=dtrain,
+            evals=evals,
+            num_boost_round=segment,
+            xgb_model=bst,
+            callbacks=callbacks)
+        rounds = bst.num_boosted_rounds()
+        bst.set_attr(**{CHECKPOINT_FINGERPRINT_ATTR: fingerprint})
+        raw = bst.save_raw("ubj")
+        if write:
+            save_checkpoint(bst, checkpoint_dir, rounds, keep)
+        bst = xgboost.Booster()
+        bst.load_model(bytearray(raw))
+    if bst is not None:
+        bst.set_attr(**{CHECKPOINT_FINGERPRINT_ATTR: None})
+    return bst
+
+
+def save_booster(booster, path):
+    """
+    Save `booster` in XGBoost's JSON format whatever the release. save_model picks the format from
+    the file extension, and for a name without one, as xgboost-model, the default changed between
+    releases and XGBoost 2 warns about it. load_booster tells the formats apart by their header.
+    """
+    booster.save_model(path + ".json")
+    os.replace(path + ".json", path)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def extract_model_archive(archive, model_dir):
+    """Unpack a model.tar.gz into `model_dir`, refusing members that would land outside it."""
+    with tarfile.open(archive) as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(path=model_dir, filter="data")
+            return
+        # Python releases without extraction filters
+        for member in tar.getmembers():
+            if (os.path.isabs(member.name) or ".." in member.name.replace("\\", "/").split("/")
+                    or not (member.isfile() or member.isdir())):
+                raise ValueError("Refusing to extract {} from {}".format(member.name, archive))
+        tar.extractall(path=model_dir)
+
+
+def load_base_model(channel_dir):
+    """
+    The booster to warm start from and its lineage record. The base_model channel holds either
+    the model.tar.gz of an earlier training job or its unpacked xgboost-model, saved natively or
+    pickled. A parent without a lineage file gets a record of its checksum and rounds only.
+    """
+    model_dir = channel_dir
+    archives = sorted(file for file in os.listdir(channel_dir) if file.endswith(".tar.gz"))
+    if archives:
+        model_dir = tempfile.mkdtemp(prefix="base-model-")
+    try:
+        if archives:
+            extract_model_archive(os.path.join(channel_dir, archives[0]), model_dir)
+        model_file = os.path.join(model_dir, MODEL_FILE_NAME)
+        with open(model_file, "rb") as f:
+            raw = f.read()
+        # The header check of load_booster, which is only defined once main() has run
+        if raw[:1] == _PICKLE_HEADER:
+            booster = pickle.loads(raw)
+        else:
+            booster = xgboost.Booster()
+            booster.load_model(bytearray(raw))
+        lineage = {"training_job": None, "parent": None, "ancestors": []}
+        if os.path.isfile(os.path.join(model_dir, LINEAGE_FILE)):
+            with open(os.path.join(model_dir, LINEAGE_FILE)) as f:
+                lineage = json.load(f)
+        lineage.update(model_sha256=file_sha256(model_file), rounds=booster.num_boosted_rounds())
+    finally:
+        if archives:
+            shutil.rmtree(model_dir)
+    # The early stopping record belongs to the parent's validation set, not to this job's
+    booster.set_attr(best_score=None, best_iteration=None, best_metric=None)
+    return booster, lineage
+
+
+def channel_shard(channel, rank, world_size):
+    """
+    The (rank, world_size) shard of a channel this worker reads, or None when it reads every file:
+    in single-worker jobs, and for channels SageMaker already splits across hosts by S3 key.
+    """
+    config = json.loads(os.environ.get("SM_INPUT_DATA_CONFIG", "{}")).get(channel, {})
+    if world_size == 1 or config.get("S3DistributionType") == "ShardedByS3Key":
+        return None
+    return rank, world_size
+
+
+@contextmanager
+def collective(hosts, current_host, port):
+    """
+    Join XGBoost's collective communicator as worker hosts.index(current_host) of len(hosts), so
+    xgboost.train combines the workers' gradient statistics every round. The first host also runs
+    the tracker the workers meet at. Yields this worker's rank.
+    """
+    # Imported here: serving containers import this script with XGBoost releases that lack them
+    from xgboost.collective import CommunicatorContext
+    from xgboost.tracker import RabitTracker
+
+    rank = hosts.index(current_host)
+    tracker_ip = socket.gethostbyname(hosts[0])
+    tracker = None
+    if rank == 0:
+        tracker = RabitTracker(n_workers=len(hosts), host_ip=tracker_ip, port=port, sortby="task")
+        tracker.start()
+    try:
+        with CommunicatorContext(dmlc_communicator="rabit", dmlc_tracker_uri=tracker_ip, dmlc_tracker_port=port,
+                                 dmlc_task_id=str(rank)):
+            yield rank
+        if tracker is not None:
+            tracker.wait_for()
+    finally:
+        # Also when training fails, so the leader does not leave the tracker waiting for workers
+        if tracker is not None:
+            tracker.free()
+
+
 def main():
     
     args = parse_args()
 
+    if len(args.hosts) > 1:
+        if XGBOOST_VERSION < (2, 1):
+            raise ValueError("Training on more than one instance needs XGBoost 2.1 or later (a framework_version "
+                             "of 2.1 or later), this is {}".format(xgboost.__version__))
+        with collective(args.hosts, args.current_host, args.tracker_port) as rank:
+            fit(args, rank, len(args.hosts))
+    else:
+        fit(args)
+
+
+def fit(args, rank=0, world_size=1):
+    """Train on this worker's part of the channels; the leader (rank 0) writes the model and debugger output."""
     train, validation = args.train, args.validation
-    parse_csv = "?format=csv&label_column=0"
-    dtrain = xgboost.DMatrix(train+parse_csv)
-    dval = xgboost.DMatrix(validation+parse_csv)
+    train_shard = channel_shard("train", rank, world_size)
+    validation_shard = channel_shard("validation", rank, world_size)
+    batch_rows = args.external_memory_batch_rows
+    cache_dir = None
+    if batch_rows > 0:
+        cache_dir = tempfile.mkdtemp(prefix="xgboost-cache-", dir=args.external_memory_dir)
+    if args.tree_method == "hist" and hasattr(xgboost, "QuantileDMatrix"):
+        batch_rows = batch_rows or MEMORY_BATCH_ROWS
+        dtrain = load_channel_quantile(train, batch_rows, args.max_bin, cache_dir=cache_dir, shard=train_shard)
+        dval = load_channel_quantile(validation, batch_rows, args.max_bin, ref=dtrain, cache_dir=cache_dir,
+                                     shard=validation_shard)
+    elif cache_dir is not None:
+        dtrain = load_channel_external(train, batch_rows, cache_dir, train_shard)
+        dval = load_channel_external(validation, batch_rows, cache_dir, validation_shard)
+    else:
+        dtrain = load_channel(train, train_shard)
+        dval = load_channel(validation, validation_shard)
 
     watchlist = [(dtrain, "train"), (dval, "validation")]
 
@@ -71,6 +704,14 @@ def main():
         "subsample": args.subsample,
         "verbosity": args.verbosity,
         "objective": args.objective}
+    if args.eval_metric:
+        params["eval_metric"] = args.eval_metric
+    if args.tree_method:
+        params["tree_method"] = args.tree_method
+    if args.tree_method in BINNED_TREE_METHODS:
+        params["max_bin"] = args.max_bin
+    if args.nthread > 0:
+        params["nthread"] = args.nthread
 
     # The output_uri is a the URI for the s3 bucket where the metrics will be
     # saved.
@@ -86,26 +727,95 @@ def main():
         else None
     )
 
-    hook = create_smdebug_hook(
-        out_dir=output_uri,
-        frequency=args.smdebug_frequency,
-        collections=collections,
-        train_data=dtrain,
-        validation_data=dval,
-    )
+    callbacks = []
+    if rank == 0 and args.metrics_mode == "callback":
+        callbacks.append(AsyncMetricsCallback(args.metrics_path, args.metrics_batch_rounds))
+    elif rank == 0 and args.metrics_mode == "smdebug":
+        callbacks.append(create_smdebug_hook(
+            out_dir=output_uri,
+            frequency=args.smdebug_frequency,
+            collections=collections,
+            train_data=dtrain,
+            validation_data=dval,
+        ))
+
+    base_model = parent = None
+    num_round = args.num_round
+    if args.base_model is not None:
+        if XGBOOST_VERSION < (1, 4):
+            raise ValueError("base_model needs XGBoost 1.4 or later (framework_version 1.5-1 or later), "
+                             "this is {}".format(xgboost.__version__))
+        base_model, parent = load_base_model(args.base_model)
+        num_round = base_model.num_boosted_rounds() + args.warm_start_rounds
+        print("Warm starting from a model of {} rounds".format(base_model.num_boosted_rounds()))
+
+    # Last, so the callbacks before it still see the round it stops on. Every worker of a distributed
+    # job gets the same allreduced metrics and stops on the same round
+    if args.early_stopping_rounds > 0:
+        if XGBOOST_VERSION < (1, 4):
+            raise ValueError("early_stopping_rounds needs XGBoost 1.4 or later (framework_version 1.5-1 or "
+                             "later), this is {}".format(xgboost.__version__))
+        callbacks.append(EarlyStoppingCallback(args.early_stopping_rounds))
+
+    if args.checkpoint_frequency > 0:
+        if XGBOOST_VERSION < (1, 6):
+            raise ValueError("checkpoint_frequency needs XGBoost 1.6 or later (framework_version 1.7-1 or "
+                             "later), this is {}".format(xgboost.__version__))
+        fingerprint = checkpoint_fingerprint(params, [train, validation], parent)
+        bst = train_with_checkpoints(params, dtrain, num_round, watchlist, callbacks, args.checkpoint_dir,
+                                     args.checkpoint_frequency, args.checkpoint_keep, args.early_stopping_rounds,
+                                     base_model, write=rank == 0, fingerprint=fingerprint)
+    else:
+        bst = xgboost.train(
+            params=params,
+            dtrain=dtrain,
+            evals=watchlist,
+            num_boost_round=num_round - (base_model.num_boosted_rounds() if base_model is not None else 0),
+            xgb_model=base_model,
+            callbacks=callbacks)
+
+    if cache_dir is not None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if rank != 0:
+        return
 
-    bst = xgboost.train(
-        params=params,
-        dtrain=dtrain,
-        evals=watchlist,
-        num_boost_round=args.num_round,
-        callbacks=[hook])
-    
     if not os.path.exists(args.model_dir):
         os.makedirs(args.model_dir)
 
-    model_location = os.path.join(args.model_dir, 'xgboost-model')
-    pickle.dump(bst, open(model_location, 'wb'))
+    if args.early_stopping_rounds > 0:
+        best = {
+            "best_iteration": int(bst.attr("best_iteration")),
+            "best_score": float(bst.attr("best_score")),
+            "metric": bst.attr("best_metric"),
+            "rounds_trained": bst.num_boosted_rounds(),
+        }
+        print("Best round {best_iteration} with {metric} {best_score} of {rounds_trained} trained".format(**best))
+        # Endpoints only evaluate the trees up to the best round
+        bst = bst[:best["best_iteration"] + 1]
+        with open(os.path.join(args.model_dir, BEST_ITERATION_FILE), "w") as f:
+            json.dump(best, f, indent=2)
+
+    model_location = os.path.join(args.model_dir, MODEL_FILE_NAME)
+    save_booster(bst, model_location)
+
+    lineage = {
+        "training_job": os.environ.get("TRAINING_JOB_NAME"),
+        "model_sha256": file_sha256(model_location),
+        "rounds": bst.num_boosted_rounds(),
+        "parent": None,
+        "ancestors": [],
+    }
+    if parent is not None:
+        lineage["rounds_added"] = lineage["rounds"] - parent["rounds"]
+        lineage["parent"] = {key: parent.get(key) for key in ["training_job", "model_sha256", "rounds"]}
+        lineage["ancestors"] = ([parent["parent"]] if parent.get("parent") else []) + parent.get("ancestors", [])
+    with open(os.path.join(args.model_dir, LINEAGE_FILE), "w") as f:
+        json.dump(lineage, f, indent=2)
+
+    if args.schema is not None:
+        # Ship the encoding schema with the model so that endpoints can encode raw records
+        shutil.copy(os.path.join(args.schema, ENCODING_SCHEMA_FILE), args.model_dir)
 
 
 if __name__ == "__main__":
@@ -113,6 +823,491 @@ if __name__ == "__main__":
     main()
 
 
+def available_cores():
+    """Number of cores this process may run on, honouring CPU affinity where the platform exposes it."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def model_server_workers(cores):
+    """Workers the model server starts; it defaults to one per core."""
+    return int(os.environ.get("SAGEMAKER_MODEL_SERVER_WORKERS", cores))
+
+
+def choose_nthread(batch_size=None, cores=None, workers=None):
+    """Pick `nthread` for a served booster.
+    Args:
+        batch_size: rows in the request, or None when no request is known yet.
+        cores: detected cores, defaults to available_cores().
+        workers: model server workers, defaults to model_server_workers().
+    Returns:
+        The number of threads the booster should use.
+    """
+    if NTHREAD_OVERRIDE:
+        return int(NTHREAD_OVERRIDE)
+    cores = cores or available_cores()
+    workers = workers or model_server_workers(cores)
+    nthread = max(1, cores // max(1, workers))
+    if batch_size is not None:
+        nthread = min(nthread, max(1, batch_size // MIN_ROWS_PER_THREAD))
+    return nthread
+
+
+def set_nthread(booster, nthread):
+    """
+    Update the booster's thread count only when it changes. Not for the booster model_fn returned
+    once requests score on it, as it is shared: see booster_for.
+    """
+    if getattr(booster, "served_nthread", None) != nthread:
+        booster.set_param('nthread', nthread)
+        booster.served_nthread = nthread
+
+
+def booster_for(booster, nthread):
+    """
+    `booster` itself if it already runs `nthread` threads, otherwise the calling thread's copy of it,
+    with `nthread` rounded down to 1, 2, 4 ... set_param on the booster model_fn returned would change
+    the thread count under every other request scoring on it at the same time. Each thread keeps one
+    copy and only resets its thread count, so there are never more copies than serving threads.
+    """
+    if getattr(booster, "served_nthread", None) == nthread:
+        return booster
+    # Powers of two, so requests of varying sizes do not reset the copy's thread count every time
+    nthread = 1 << (nthread.bit_length() - 1)
+    source, copy = getattr(_THREAD_BOOSTERS, "copy", (None, None))
+    if source is not booster:
+        copy = booster.copy()
+        copy.served_nthread = None
+        _THREAD_BOOSTERS.copy = booster, copy
+    set_nthread(copy, nthread)
+    return copy
+
+
+# find_model_file and load_booster are copied into each handler script (4-Deployment Batch and
+# RealTime, 5-Monitoring, 6-Pipelines), since every one is deployed as a single file: keep them in sync
+def find_model_file(model_dir):
+    """Pick the model artifact deterministically: `xgboost-model` if present, else the first file by name."""
+    if os.path.isfile(os.path.join(model_dir, MODEL_FILE_NAME)):
+        return os.path.join(model_dir, MODEL_FILE_NAME)
+    model_files = sorted(file for file in os.listdir(model_dir)
+                         if not file.startswith(".") and os.path.isfile(os.path.join(model_dir, file)))
+    if not model_files:
+        raise ValueError("No model file found in {}".format(model_dir))
+    return os.path.join(model_dir, model_files[0])
+
+
+def load_booster(model_dir):
+    """Load a booster saved in XGBoost's native binary, JSON or UBJSON format, or a pickled one.
+    The format is detected from the file header, so no load attempt has to fail first.
+    Returns:
+        A XGBoost model.
+        XGBoost model format type.
+    """
+    model_file = find_model_file(model_dir)
+    with open(model_file, "rb") as f:
+        raw = f.read()
+    try:
+        if raw[:1] == _PICKLE_HEADER:
+            return pickle.loads(raw), 'pkl_format'
+        booster = xgboost.Booster()
+        booster.load_model(bytearray(raw))
+        return booster, 'xgb_format'
+    except Exception as e:
+        raise ValueError("Unable to load model {}: {}".format(model_file, str(e)))
+
+
+def warm_up(booster, num_features=NUM_FEATURES):
+    """Run throw-away predictions so the first request does not pay for lazy initialization."""
+    features = np.zeros((1, num_features), dtype=np.float32)
+    booster.predict(xgboost.DMatrix(features))
+    if hasattr(booster, "inplace_predict"):
+        booster.inplace_predict(features)
+
+
+class PredictionCache(object):
+    """Size-bounded LRU cache of row predictions with an optional TTL.
+    Keys hash the bytes of the parsed float32 row together with the model version, so "1" and
+    "1.0" share an entry and predictions cached for one model are never served by another.
+    """
+
+    def __init__(self, max_size, ttl=0, model_version=""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lookups = 0
+        self._seed = hashlib.blake2b(model_version.encode("utf-8"), digest_size=16)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, row):
+        digest = self._seed.copy()
+        digest.update(row)
+        return digest.digest()
+
+    def get_many(self, keys):
+        """Return the cached prediction for each key, or None for a miss."""
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            self.lookups += 1
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and self.ttl and now - entry[1] > self.ttl:
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    values.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    values.append(entry[0])
+        return values
+
+    def put_many(self, keys, values):
+        """Cache the predictions; returns the number of entries evicted to make room."""
+        now = time.monotonic()
+        evicted = 0
+        with self._lock:
+            for key, value in zip(keys, values):
+                self._entries[key] = (value, now)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class _PendingRequest(object):
+
+    def __init__(self, features):
+        self.features = features
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """Gathers concurrent requests into one booster call.
+    A background thread takes the first pending request, keeps collecting until max_batch_size
+    rows are queued or max_wait_us microseconds have passed, scores the stacked rows once and
+    hands every caller back its own slice of the result.
+    """
+
+    def __init__(self, predict, max_batch_size, max_wait_us):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_us / 1e6
+        self._predict = predict
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def predict(self, features):
+        self._ensure_started()
+        request = _PendingRequest(features)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _ensure_started(self):
+        # Model servers may fork workers after model_fn, and threads do not survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, name="micro-batcher", daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        rows = len(batch[0].features)
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            rows += len(request.features)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                if len(batch) == 1:
+                    batch[0].result = self._predict(batch[0].features)
+                else:
+                    scores = self._predict(np.concatenate([request.features for request in batch]))
+                    offset = 0
+                    for request in batch:
+                        request.result = scores[offset:offset + len(request.features)]
+                        offset += len(request.features)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+
+class Histogram(object):
+    """
+    Log-bucketed histogram: bucket i counts values in [lowest * growth**i, lowest * growth**(i + 1)),
+    so recording is one log and one list increment.
+    """
+
+    def __init__(self, lowest, growth=1.25, buckets=100):
+        self.lowest = lowest
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.counts = [0] * buckets
+
+    def record(self, value):
+        bucket = int(math.log(value / self.lowest) / self._log_growth) if value > self.lowest else 0
+        self.counts[min(bucket, len(self.counts) - 1)] += 1
+
+    def to_emf(self):
+        """
+        The recorded values as an EMF metric value, a plain array of numbers: the bucket midpoints
+        (`lowest` for the first), each repeated by its count. EMF takes at most MAX_EMF_VALUES values
+        per metric, so past that the array holds evenly spaced quantiles instead, which keeps the
+        percentiles but caps the sample count CloudWatch sees.
+        """
+        total = sum(self.counts)
+        size = min(total, MAX_EMF_VALUES)
+        values = []
+        bucket, below = 0, self.counts[0]
+        for i in range(size):
+            rank = i * total // size
+            while rank >= below:
+                bucket += 1
+                below += self.counts[bucket]
+            values.append(self.lowest * self.growth ** (bucket + 0.5) if bucket else self.lowest)
+        return values
+
+
+class StageMetrics(object):
+    """
+    In-process histograms of handler stage latencies and sizes. A daemon thread, started lazily in
+    each worker process, swaps the histograms out every flush_seconds and prints them as one
+    CloudWatch Embedded Metric Format line, which CloudWatch Logs turns into metrics.
+    """
+
+    # Smallest value each unit resolves: 1 microsecond, one row, one byte
+    LOWEST = {"Milliseconds": 0.001, "Count": 1, "Bytes": 1}
+
+    def __init__(self, flush_seconds, namespace, dimensions):
+        self.flush_seconds = flush_seconds
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self._histograms = {}
+        self._counts = {}
+        self._units = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def record_stage(self, stage, start, size_name, size, size_unit):
+        """Record the time since `start` as `stage`Latency and the size the stage handled."""
+        latency_ms = 1000 * (time.perf_counter() - start)
+        if self._pid != os.getpid():
+            self._start()
+        with self._lock:
+            self._histogram(stage + "Latency", "Milliseconds").record(latency_ms)
+            self._histogram(size_name, size_unit).record(size)
+
+    def record_counts(self, counts):
+        """Add to counters that are emitted, as Count metrics, with the histograms of the next flush."""
+        if self._pid != os.getpid():
+            self._start()
+        with self._lock:
+            for name, value in counts.items():
+                self._counts[name] = self._counts.get(name, 0) + value
+
+    def _histogram(self, name, unit):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram(self.LOWEST[unit])
+            self._units[name] = unit
+        return histogram
+
+    def _start(self):
+        # Model servers may fork workers after the module is imported, and threads do not survive a fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._histograms = {}
+                self._counts = {}
+                threading.Thread(target=self._run, name="stage-metrics", daemon=True).start()
+                atexit.register(self.flush)
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+            counts, self._counts = self._counts, {}
+        if not histograms and not counts:
+            return
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(self.dimensions)],
+                    "Metrics": [{"Name": name, "Unit": self._units[name]} for name in histograms]
+                               + [{"Name": name, "Unit": "Count"} for name in counts],
+                }],
+            },
+        }
+        document.update(self.dimensions)
+        document.update((name, histogram.to_emf()) for name, histogram in histograms.items())
+        document.update(counts)
+        print(json.dumps(document), flush=True)
+
+
+METRICS = (StageMetrics(METRICS_FLUSH_SECONDS, METRICS_NAMESPACE,
+                        {"Handler": os.path.splitext(os.path.basename(__file__))[0]})
+           if METRICS_FLUSH_SECONDS > 0 else None)
+
+
+class SamplingProfiler(object):
+    """
+    Wall-clock sampling profiler. While a run is active, a background thread records the Python
+    stack of every other thread each interval_ms and, when the run ends, writes the counts in
+    collapsed-stack format ("outer;...;inner count" per line) that flamegraph.pl and speedscope
+    render. Nothing runs between runs; one run per process at a time.
+    """
+
+    # Helper threads whose idle waits would only add noise to the profile
+    IGNORED_THREADS = ("stage-metrics",)
+
+    def __init__(self, interval_ms, output_dir=None):
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self.last_output = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._remaining = 0
+        self._pid = None
+
+    @property
+    def running(self):
+        # A worker forked during a run inherits _thread but not the thread itself
+        return self._thread is not None and self._pid == os.getpid()
+
+    def start(self, seconds=0, requests=0):
+        """Start a run that ends after `seconds`, or after `requests` calls to request_done()."""
+        if seconds <= 0 and requests <= 0:
+            raise ValueError("A profiler run needs a positive number of seconds or requests")
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return False
+            self._pid = os.getpid()
+            self._remaining = requests
+            self._deadline = time.monotonic() + seconds if seconds else None
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        return True
+
+    def request_done(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if self._remaining > 0:
+                self._remaining -= 1
+                if self._remaining == 0:
+                    self._stop.set()
+
+    def _run(self):
+        me = threading.get_ident()
+        started = int(time.time() * 1000)
+        stacks = {}
+        while not self._stop.wait(self.interval):
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                break
+            ignored = {thread.ident for thread in threading.enumerate() if thread.name in self.IGNORED_THREADS}
+            ignored.add(me)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in ignored:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+        try:
+            self._write(stacks, started)
+        finally:
+            with self._lock:
+                self._thread = None
+
+    def _write(self, stacks, started):
+        output_dir = self.output_dir or tempfile.gettempdir()
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, "profile-{}-{}.collapsed".format(os.getpid(), started))
+        with open(path, "w") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+        self.last_output = path
+        print("Wrote {} samples of {} stacks to {}".format(sum(stacks.values()), len(stacks), path), flush=True)
+
+
+def split_profile_request(content_type):
+    """
+    Strip a "profile=<n>" (requests) or "profile=<n>s" (seconds) parameter from a Content-Type value.
+    Returns the remaining content type and the (seconds, requests) of the run it asks for, if any.
+    """
+    params = [param.strip() for param in content_type.split(";")]
+    run = None
+    for param in params[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "profile":
+            value = value.strip().lower()
+            run = (float(value[:-1]), 0) if value.endswith("s") else (0, int(value))
+            params.remove(param)
+            break
+    return "; ".join(params), run
+
+
+PROFILER = SamplingProfiler(PROFILE_INTERVAL_MS, PROFILE_DIR)
+if PROFILE_SECONDS > 0 or PROFILE_REQUESTS > 0:
+    PROFILER.start(PROFILE_SECONDS, PROFILE_REQUESTS)
+
+
+def model_version(model_dir):
+    """Content hash of the model artifact."""
+    with open(find_model_file(model_dir), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
 def model_fn(model_dir):
     """Load a model. For XGBoost Framework, a default function to load a model is not provided.
     Users should provide customized model_fn() in script.
@@ -122,17 +1317,394 @@ def model_fn(model_dir):
         A XGBoost model.
         XGBoost model format type.
     """
-    model_files = (file for file in os.listdir(model_dir) if os.path.isfile(os.path.join(model_dir, file)))
-    model_file = next(model_files)
+    if PROFILER.output_dir is None:
+        PROFILER.output_dir = model_dir
+    booster, format = load_booster(model_dir)
+    set_nthread(booster, choose_nthread())
+    if MODEL_WARMUP:
+        warm_up(booster)
+    schema_file = os.path.join(model_dir, ENCODING_SCHEMA_FILE)
+    if os.path.exists(schema_file):
+        booster.feature_encoder = FeatureEncoder.load(schema_file)
+    if PREDICTION_CACHE_SIZE > 0:
+        booster.prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL,
+                                                   model_version(model_dir))
+    if MICRO_BATCH_MAX_SIZE > 0:
+        booster.micro_batcher = MicroBatcher(lambda features: predict_array(booster, features),
+                                             MICRO_BATCH_MAX_SIZE, MICRO_BATCH_MAX_WAIT_US)
+    return booster
+
+
+def csv_to_array(request_body, num_features=NUM_FEATURES):
+    """
+    Decode a headerless CSV body straight into a contiguous float32 array of shape
+    (rows, num_features), without building a DataFrame or decoding the body to text.
+    """
+    if isinstance(request_body, str):
+        request_body = request_body.encode("utf-8")
     try:
-        booster = pickle.load(open(os.path.join(model_dir, model_file), 'rb'))
-        format = 'pkl_format'
-    except Exception as exp_pkl:
+        if _C_LOADTXT:
+            # BytesIO shares the request buffer instead of copying it
+            values = np.loadtxt(BytesIO(request_body), delimiter=",", dtype=np.float32, ndmin=2)
+        else:
+            values = np.fromstring(request_body.strip().translate(_CSV_LINE_BREAKS), dtype=np.float32, sep=",")
+    except ValueError as e:
+        raise ValueError("Unable to parse CSV payload: {}".format(str(e)))
+    if values.ndim == 2 and values.size:
+        # loadtxt keeps the rows, so a wrong width cannot hide behind a total size that happens to divide
+        if values.shape[1] != num_features:
+            raise ValueError("Expected {} features per row, got {}".format(num_features, values.shape[1]))
+    elif values.size % num_features != 0:
+        raise ValueError("Expected {} features per row, got {} values in total".format(num_features, values.size))
+    return np.ascontiguousarray(values.reshape(-1, num_features))
+
+
+def predict_array(model, features):
+    """
+    Score a 2D NumPy array, or a DMatrix decoded from a libsvm body. In "inplace" mode the array
+    goes straight to Booster.inplace_predict; otherwise, or if the booster cannot predict in place,
+    it is wrapped in a DMatrix first.
+    """
+    if isinstance(features, xgboost.DMatrix):
+        return booster_for(model, choose_nthread(features.num_row())).predict(features)
+    model = booster_for(model, choose_nthread(len(features)))
+    if PREDICT_MODE == "inplace" and hasattr(model, "inplace_predict"):
         try:
-            booster = xgboost.Booster()
-            booster.load_model(os.path.join(model_dir, model_file))
-            format = 'xgb_format'
-        except Exception as exp_xgb:
-            raise ModelLoadInferenceError("Unable to load model: {} {}".format(str(exp_pkl), str(exp_xgb)))
-    booster.set_param('nthread', 1)
-    return booster
\ No newline at end of file
+            return model.inplace_predict(features)
+        except xgboost.core.XGBoostError:
+            pass
+    return model.predict(xgboost.DMatrix(features))
+
+
+def score(model, features):
+    """Score through the micro-batcher when it is enabled, directly otherwise."""
+    batcher = getattr(model, "micro_batcher", None)
+    if batcher is not None:
+        return batcher.predict(features)
+    return predict_array(model, features)
+
+
+def predict_cached(model, cache, features):
+    """Serve cached rows and score only the misses, in one booster call."""
+    # Adding 0 turns -0.0 into 0.0, the only two floats that compare equal with different bytes
+    rows = np.ascontiguousarray(features, dtype=np.float32) + np.float32(0)
+    keys = [cache.key(row.tobytes()) for row in rows]
+    cached = cache.get_many(keys)
+    misses = [i for i, value in enumerate(cached) if value is None]
+    predictions = np.array([np.nan if value is None else value for value in cached], dtype=np.float32)
+    evicted = 0
+    if misses:
+        scores = score(model, features[misses])
+        predictions[misses] = scores
+        evicted = cache.put_many([keys[i] for i in misses], scores.tolist())
+    if METRICS is not None:
+        METRICS.record_counts({"PredictionCacheHits": len(rows) - len(misses),
+                               "PredictionCacheMisses": len(misses),
+                               "PredictionCacheEvictions": evicted})
+    return predictions
+
+
+def npy_to_array(request_body, num_features=NUM_FEATURES):
+    """
+    Decode an .npy body into a float32 feature array. float32 C-ordered payloads are returned
+    as a read-only view of the request buffer; anything else is converted once.
+    """
+    if isinstance(request_body, str):
+        raise ValueError("{} bodies must be sent as bytes".format(NPY_CONTENT_TYPE))
+    buffer = BytesIO(request_body)
+    version = np.lib.format.read_magic(buffer)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(buffer)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(buffer)
+    if dtype.hasobject:
+        raise ValueError("Object arrays are not supported")
+    values = np.frombuffer(request_body, dtype=dtype, count=int(np.prod(shape)), offset=buffer.tell())
+    values = values.reshape(shape, order="F" if fortran_order else "C").reshape(-1, num_features)
+    return np.ascontiguousarray(values, dtype=np.float32)
+
+
+def arrow_to_array(request_body, num_features=NUM_FEATURES):
+    """
+    Decode an Arrow IPC stream with one numeric column per feature into a float32 feature array.
+    """
+    if pa is None:
+        raise ValueError("{} requires pyarrow to be installed".format(ARROW_CONTENT_TYPE))
+    table = pa.ipc.open_stream(pa.py_buffer(request_body)).read_all()
+    if table.num_columns != num_features:
+        raise ValueError("Expected {} feature columns, got {}".format(num_features, table.num_columns))
+    values = np.empty((table.num_rows, num_features), dtype=np.float32)
+    for i, column in enumerate(table.columns):
+        values[:, i] = column.to_numpy()
+    return values
+
+
+class FeatureEncoder(object):
+    """
+    Encodes raw customer records into the model's feature columns, following the encoding schema
+    written by the preprocessing step. Numeric fields are copied into their columns; each
+    categorical field sets the indicator found by a searchsorted lookup in its sorted vocabulary,
+    so a batch costs one array lookup per field. Values outside the vocabulary leave all of the
+    field's indicators at 0, as in preprocessing.
+    """
+
+    def __init__(self, schema):
+        if schema.get("version") != ENCODING_SCHEMA_VERSION:
+            raise ValueError("Unsupported encoding schema version {}".format(schema.get("version")))
+        self.fingerprint = schema.get("fingerprint")
+        self.columns = schema["columns"]
+        position = {column: i for i, column in enumerate(self.columns)}
+        self.numeric_positions = [position[name] for name in schema["numeric"]]
+        self.categorical = []
+        for name, values in schema["categorical"].items():
+            vocabulary = np.sort(np.array([str(value) for value in values]))
+            positions = np.array([position["{}_{}".format(name, value)] for value in vocabulary])
+            self.categorical.append((vocabulary, positions))
+        # One pass over the records pulls out every numeric field, and one more every categorical field
+        self._numeric_fields = itemgetter(*schema["numeric"])
+        self._categorical_fields = itemgetter(*schema["categorical"])
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def encode(self, records):
+        """Encode a list of dicts keyed by the raw column names into a float32 feature array."""
+        features = np.zeros((len(records), len(self.columns)), dtype=np.float32)
+        rows = np.arange(len(records))
+        if not records:
+            return features
+        try:
+            numeric = np.array(list(map(self._numeric_fields, records)), dtype=np.float32)
+            categorical = np.array(list(map(self._categorical_fields, records)), dtype=str)
+        except KeyError as e:
+            raise ValueError("Record is missing the {} field".format(e))
+        except TypeError:
+            raise ValueError("Records must be JSON objects keyed by the raw column names")
+        features[:, self.numeric_positions] = numeric.reshape(len(records), -1)
+        for field, (vocabulary, positions) in enumerate(self.categorical):
+            values = categorical.reshape(len(records), -1)[:, field]
+            found = np.minimum(np.searchsorted(vocabulary, values), len(vocabulary) - 1)
+            known = vocabulary[found] == values
+            features[rows[known], positions[found[known]]] = 1
+        return features
+
+
+class RawRecords(list):
+    """Raw customer records decoded from a JSON request, encoded in predict_fn by the model's FeatureEncoder."""
+
+
+def json_to_records(request_body, content_type):
+    """Parse a JSON list of records, {"instances": [...]}, a single record, or one record per JSON Lines line."""
+    if isinstance(request_body, bytes):
+        request_body = request_body.decode("utf-8")
+    if content_type == JSONLINES_CONTENT_TYPE:
+        records = [json.loads(line) for line in request_body.splitlines() if line.strip()]
+    else:
+        records = json.loads(request_body)
+        if isinstance(records, dict):
+            records = records.get("instances", [records])
+    return RawRecords(records)
+
+
+def encode_records(model, records):
+    encoder = getattr(model, "feature_encoder", None)
+    if encoder is None:
+        raise ValueError("Raw records can only be scored when the model artifact has {}".format(ENCODING_SCHEMA_FILE))
+    return encoder.encode(records)
+
+
+def libsvm_to_dmatrix(request_body):
+    """Decode a libsvm body into a DMatrix with the XGBoost container's decoder, as its default input_fn does."""
+    if xgb_encoders is None:
+        raise ValueError("{} bodies need the SageMaker XGBoost container".format(LIBSVM_CONTENT_TYPE))
+    return xgb_encoders.libsvm_to_dmatrix(request_body)
+
+
+def decode_features(request_body, content_type):
+    """
+    Decode a request body of any supported content type into a float32 feature array, or into
+    RawRecords for JSON and JSON Lines bodies of raw customer records, or into a DMatrix for
+    libsvm bodies. Parameters such as "charset=utf-8" do not change the decoder.
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type == CSV_CONTENT_TYPE:
+        return csv_to_array(request_body)
+    elif media_type == NPY_CONTENT_TYPE:
+        return npy_to_array(request_body)
+    elif media_type == ARROW_CONTENT_TYPE:
+        return arrow_to_array(request_body)
+    elif media_type in (JSON_CONTENT_TYPE, JSONLINES_CONTENT_TYPE):
+        return json_to_records(request_body, media_type)
+    elif media_type == LIBSVM_CONTENT_TYPE:
+        return libsvm_to_dmatrix(request_body)
+    else:
+        raise ValueError("Content type {} is not supported.".format(content_type))
+
+
+def parse_accept(accept):
+    """
+    Split an Accept value such as "text/csv; output=both; threshold=0.3; row_id=true" into its
+    media type and the output options for this request. Without parameters, "plain" asks for the
+    response format of the handler before they existed (see PLAIN_JSON_KEY).
+    """
+    media_type, _, params = (accept or CSV_CONTENT_TYPE).partition(";")
+    options = {"output": DEFAULT_OUTPUT, "threshold": DEFAULT_THRESHOLD, "row_id": False,
+               "plain": not params.strip()}
+    for param in params.split(";"):
+        key, _, value = param.partition("=")
+        key, value = key.strip().lower(), value.strip().strip('"')
+        if not key:
+            continue
+        elif key == "output":
+            if value not in ("probability", "label", "both"):
+                raise ValueError("output must be probability, label or both, got {}".format(value))
+            options["output"] = value
+        elif key == "threshold":
+            options["threshold"] = float(value)
+        elif key == "row_id":
+            options["row_id"] = value.lower() in ("true", "1", "yes")
+    return media_type.strip().lower(), options
+
+
+def output_columns(probabilities, options):
+    """Name and values of every field the caller asked for, in output order."""
+    columns = []
+    if options["row_id"]:
+        columns.append(("id", np.arange(len(probabilities))))
+    if options["output"] in ("probability", "both"):
+        columns.append(("probability", probabilities))
+    if options["output"] in ("label", "both"):
+        columns.append(("label", (probabilities >= options["threshold"]).astype(np.uint8)))
+    return columns
+
+
+# The output encoders below are copied into each handler script (4-Deployment Batch and RealTime,
+# 5-Monitoring), since every one is deployed as a single file: keep them in sync
+def _text_column(values, null):
+    """
+    Text of one output field per row: integers as they are, other values with PROBABILITY_DECIMALS
+    decimals, and `null` for NaN or infinite scores.
+    """
+    if values.dtype.kind in "iu":
+        return values.astype(str)
+    text = np.char.mod("%.{}f".format(PROBABILITY_DECIMALS), values.astype(np.float64))
+    return np.where(np.isfinite(values), text, null)
+
+
+def _json_values(values):
+    """The values as a list for json.dumps, with None (null) in place of NaN or infinite scores."""
+    if values.dtype.kind in "iu":
+        return values.tolist()
+    return np.where(np.isfinite(values), values.astype(object), None).tolist()
+
+
+def encode_lines(columns, prefixes, suffix, null):
+    """One line per row, `prefixes[i]` + field i ... + `suffix`, built a column at a time with np.char."""
+    lines = ""
+    for prefix, (_, values) in zip(prefixes, columns):
+        lines = np.char.add(np.char.add(lines, prefix), _text_column(values, null))
+    return "\n".join(np.char.add(lines, suffix).tolist()).encode("utf-8")
+
+
+def encode_plain(values, media_type):
+    """One field as the handler wrote it before Accept parameters: str() per line, or JSON (see PLAIN_JSON_KEY)."""
+    values = values.astype(np.float64).tolist()
+    if media_type == CSV_CONTENT_TYPE:
+        return "\n".join(map(str, values)).encode("utf-8")
+    return json.dumps(values if PLAIN_JSON_KEY is None else {PLAIN_JSON_KEY: values})
+
+
+def encode_predictions(probabilities, accept):
+    """
+    Serialize a 1D array of probabilities as CSV, JSON Lines, JSON, .npy or Arrow. Parameters of
+    the Accept value select the fields and the fixed-decimal text of PROBABILITY_DECIMALS (see
+    parse_accept); CSV and JSON without them are written as before (see PLAIN_JSON_KEY).
+    """
+    media_type, options = parse_accept(accept)
+    columns = output_columns(np.asarray(probabilities), options)
+    rows = len(probabilities)
+    if options["plain"] and len(columns) == 1 and media_type in (CSV_CONTENT_TYPE, JSON_CONTENT_TYPE):
+        return encode_plain(columns[0][1], media_type)
+    if media_type == CSV_CONTENT_TYPE:
+        if rows == 0:
+            return b""
+        prefixes = [""] + [","] * (len(columns) - 1)
+        return encode_lines(columns, prefixes, "", "nan")
+    elif media_type == JSONLINES_CONTENT_TYPE:
+        if rows == 0:
+            return b""
+        prefixes = ['{}"{}":'.format("," if i else "{", name) for i, (name, _) in enumerate(columns)]
+        return encode_lines(columns, prefixes, "}", "null")
+    elif media_type == JSON_CONTENT_TYPE:
+        if len(columns) == 1:
+            return json.dumps({"predictions": _json_values(columns[0][1])})
+        names = [name for name, _ in columns]
+        records = zip(*(_json_values(values) for _, values in columns))
+        return json.dumps({"predictions": [dict(zip(names, record)) for record in records]})
+    elif media_type == NPY_CONTENT_TYPE:
+        values = [values.astype(np.float32) for _, values in columns]
+        buffer = BytesIO()
+        np.save(buffer, values[0] if len(values) == 1 else np.column_stack(values), allow_pickle=False)
+        return buffer.getvalue()
+    elif media_type == ARROW_CONTENT_TYPE:
+        if pa is None:
+            raise ValueError("{} requires pyarrow to be installed".format(ARROW_CONTENT_TYPE))
+        table = pa.table({name: values for name, values in columns})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    else:
+        raise ValueError("Content type {} is not supported.".format(accept))
+
+
+def input_fn(request_body, content_type):
+    """
+    Deserialize a CSV, .npy, Arrow IPC stream, JSON or libsvm request. With PROFILE_ON_REQUEST set,
+    a "profile" Content-Type parameter starts a sampling profiler run (see split_profile_request).
+    """
+    start = time.perf_counter()
+    if PROFILE_ON_REQUEST and ";" in content_type:
+        content_type, profile = split_profile_request(content_type)
+        if profile is not None:
+            PROFILER.start(*profile)
+    data = decode_features(request_body, content_type)
+    if METRICS is not None:
+        METRICS.record_stage("Input", start, "RequestBytes", len(request_body), "Bytes")
+    return data
+
+
+def predict_fn(input_object, model):
+    """
+    Perform prediction on the deserialized object, with the loaded model.
+    """
+    start = time.perf_counter()
+    if isinstance(input_object, RawRecords):
+        input_object = encode_records(model, input_object)
+    cache = getattr(model, "prediction_cache", None)
+    if isinstance(input_object, xgboost.DMatrix):
+        # libsvm rows are sparse: neither cached nor micro-batched
+        prediction = predict_array(model, input_object)
+    elif cache is not None:
+        prediction = predict_cached(model, cache, input_object)
+    else:
+        prediction = score(model, input_object)
+    if METRICS is not None:
+        METRICS.record_stage("Predict", start, "BatchSize", len(prediction), "Count")
+    return prediction
+
+
+def output_fn(prediction, content_type):
+    """
+    Serialize the predictions as CSV (one line per row), JSON Lines, JSON, .npy or Arrow, with
+    the fields, label threshold and row id chosen by the Accept parameters (see parse_accept).
+    """
+    start = time.perf_counter()
+    response = encode_predictions(prediction, content_type)
+    if METRICS is not None:
+        METRICS.record_stage("Output", start, "ResponseBytes", len(response), "Bytes")
+    if PROFILER.running:
+        PROFILER.request_done()
+    return response
@@ -0,0 +1,273 @@
+"""Local benchmarks for the handler functions in inference.py.
+
+Runs the input_fn -> predict_fn -> output_fn chain in-process, without a model
+server, so the numbers only reflect the cost of the handler code itself.
+
+    python benchmark_inference.py --model-dir /path/to/extracted/model
+    python benchmark_inference.py --benchmark predict-modes
+    python benchmark_inference.py --benchmark cold-start
+    python benchmark_inference.py --benchmark formats
+    python benchmark_inference.py --benchmark instrumentation
+
+`--handler` points the benchmarks at any other handler script in the repo that
+defines input_fn, predict_fn and output_fn.
+"""
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+import xgboost
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(PATH))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import load_handler, print_table, read_rows, train_model
+
+DEFAULT_ROWS = os.path.join(PATH, "test-dataset-input-cols.csv")
+
+
+def run_requests(handler, model, payloads, content_type="text/csv"):
+    start = time.perf_counter()
+    for payload in payloads:
+        data = handler.input_fn(payload, content_type)
+        prediction = handler.predict_fn(data, model)
+        handler.output_fn(prediction, content_type)
+    return time.perf_counter() - start
+
+
+def make_payloads(rows, total_rows, batch_size):
+    """Build request bodies of `batch_size` rows until `total_rows` are covered."""
+    payloads = []
+    for start in range(0, total_rows, batch_size):
+        batch = [rows[i % len(rows)] for i in range(start, min(start + batch_size, total_rows))]
+        payloads.append("\n".join(batch))
+    return payloads
+
+
+def benchmark_batching(handler, model, rows, total_rows, batch_sizes):
+    results = []
+    for batch_size in batch_sizes:
+        payloads = make_payloads(rows, total_rows, batch_size)
+        elapsed = run_requests(handler, model, payloads)
+        results.append({
+            "batch_size": batch_size,
+            "requests": len(payloads),
+            "seconds": elapsed,
+            "rows_per_sec": total_rows / elapsed,
+            "ms_per_request": 1000 * elapsed / len(payloads),
+        })
+    return results
+
+
+def benchmark_predict_modes(handler, model, rows, batch_sizes, repeat=20):
+    """Compare predict_fn latency with and without a DMatrix per request."""
+    features = handler.csv_to_array("\n".join(rows))
+    results = []
+    for batch_size in batch_sizes:
+        batch = np.ascontiguousarray(np.resize(features, (batch_size, features.shape[1])))
+        for mode in ("dmatrix", "inplace"):
+            handler.PREDICT_MODE = mode
+            handler.predict_fn(batch, model)
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                handler.predict_fn(batch, model)
+                timings.append(time.perf_counter() - start)
+            results.append({
+                "mode": mode,
+                "batch_size": batch_size,
+                "p50_ms": 1000 * float(np.percentile(timings, 50)),
+                "min_ms": 1000 * min(timings),
+                "us_per_row": 1e6 * float(np.percentile(timings, 50)) / batch_size,
+            })
+    return results
+
+
+def first_request(handler_path, model_dir, row):
+    """Load the handler and serve one request; runs inside a fresh process."""
+    start = time.perf_counter()
+    handler = load_handler(handler_path)
+    model = handler.model_fn(model_dir)
+    loaded = time.perf_counter()
+    handler.output_fn(handler.predict_fn(handler.input_fn(row, "text/csv"), model), "text/csv")
+    done = time.perf_counter()
+    return {
+        "first_prediction_at": time.time(),
+        "model_fn_ms": 1000 * (loaded - start),
+        "first_request_ms": 1000 * (done - loaded),
+    }
+
+
+def benchmark_cold_start(handler_path, model_dir, repeat=5):
+    """Time process start to first prediction for each artifact format, with and without warm-up."""
+    pickle_dir = os.path.join(tempfile.mkdtemp(), "pickle-model")
+    os.makedirs(pickle_dir)
+    booster = xgboost.Booster()
+    booster.load_model(os.path.join(model_dir, "xgboost-model"))
+    with open(os.path.join(pickle_dir, "xgboost-model"), "wb") as f:
+        pickle.dump(booster, f)
+
+    results = []
+    for artifact, artifact_dir in (("native", model_dir), ("pickle", pickle_dir)):
+        for warmup in ("true", "false"):
+            runs = []
+            for _ in range(repeat):
+                env = dict(os.environ, MODEL_WARMUP=warmup)
+                started = time.time()
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--benchmark", "first-request",
+                     "--handler", os.path.abspath(handler_path), "--model-dir", artifact_dir],
+                    env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                ).stdout
+                run = json.loads(output.strip().splitlines()[-1])
+                run["cold_start_ms"] = 1000 * (run.pop("first_prediction_at") - started)
+                runs.append(run)
+            results.append(dict(
+                {"artifact": artifact, "warmup": warmup},
+                **{key: float(np.median([run[key] for run in runs])) for key in runs[0]}
+            ))
+    return results
+
+
+FORMAT_NAMES = {"text/csv": "csv", "application/x-npy": "npy", "application/vnd.apache.arrow.stream": "arrow"}
+
+
+def encode_request(features, content_type):
+    """Serialize a feature array the way a client would before calling the endpoint."""
+    if content_type == "text/csv":
+        return "\n".join(",".join(map(str, row)) for row in features.tolist()).encode("utf-8")
+    elif content_type == "application/x-npy":
+        buffer = BytesIO()
+        np.save(buffer, features)
+        return buffer.getvalue()
+    table = pa.table({"f{}".format(i): features[:, i] for i in range(features.shape[1])})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def decode_response(body, content_type):
+    if content_type == "text/csv":
+        return np.array(body.split(b"\n"), dtype=np.float32)
+    elif content_type == "application/x-npy":
+        return np.load(BytesIO(body))
+    return pa.ipc.open_stream(pa.py_buffer(body)).read_all().column(0).to_numpy()
+
+
+def benchmark_formats(handler, model, rows, batch_sizes, repeat=20):
+    """Bytes on the wire and client encode -> handler -> client decode latency per content type."""
+    features = handler.csv_to_array("\n".join(rows))
+    content_types = ["text/csv", "application/x-npy"]
+    if pa is not None:
+        content_types.append("application/vnd.apache.arrow.stream")
+    results = []
+    for batch_size in batch_sizes:
+        batch = np.ascontiguousarray(np.resize(features, (batch_size, features.shape[1])))
+        for content_type in content_types:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                request = encode_request(batch, content_type)
+                data = handler.input_fn(request, content_type)
+                response = handler.output_fn(handler.predict_fn(data, model), content_type)
+                decode_response(response, content_type)
+                timings.append(time.perf_counter() - start)
+            results.append({
+                "format": FORMAT_NAMES[content_type],
+                "batch_size": batch_size,
+                "request_bytes": len(request),
+                "response_bytes": len(response),
+                "p50_ms": 1000 * float(np.percentile(timings, 50)),
+            })
+    return results
+
+
+def benchmark_instrumentation(handler, model, rows, batch_sizes, repeat=2000):
+    """
+    Per-request cost of the stage metrics: the handler chain with METRICS off and on, and the three
+    record_stage calls of one request timed on their own, which end-to-end noise does not swamp.
+    """
+    metrics = handler.METRICS or handler.StageMetrics(60, "benchmark", {})
+    start = time.perf_counter()
+    for _ in range(repeat):
+        metrics.record_stage("Input", time.perf_counter(), "RequestBytes", 300, "Bytes")
+        metrics.record_stage("Predict", time.perf_counter(), "BatchSize", 1, "Count")
+        metrics.record_stage("Output", time.perf_counter(), "ResponseBytes", 8, "Bytes")
+    record_seconds = (time.perf_counter() - start) / repeat
+
+    results = []
+    for batch_size in batch_sizes:
+        payload = make_payloads(rows, batch_size, batch_size)[0]
+        timings = {}
+        for enabled in (False, True) * 3:
+            handler.METRICS = metrics if enabled else None
+            start = time.perf_counter()
+            for _ in range(repeat):
+                handler.output_fn(handler.predict_fn(handler.input_fn(payload, "text/csv"), model), "text/csv")
+            seconds = (time.perf_counter() - start) / repeat
+            timings[enabled] = min(timings.get(enabled, seconds), seconds)
+        results.append({
+            "batch_size": batch_size,
+            "off_us": 1e6 * timings[False],
+            "on_us": 1e6 * timings[True],
+            "record_us": 1e6 * record_seconds,
+        })
+    handler.METRICS = metrics
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--handler", type=str, default=os.path.join(PATH, "inference.py"))
+    parser.add_argument("--model-dir", type=str, default=None,
+                        help="Directory with the extracted model artifact. A model is trained on "
+                             "2-Modeling/config/train.csv when omitted.")
+    parser.add_argument("--rows", type=str, default=DEFAULT_ROWS)
+    parser.add_argument("--total-rows", type=int, default=5000)
+    parser.add_argument("--benchmark", type=str, default="batching", choices=["batching", "predict-modes", "cold-start", "first-request", "formats", "instrumentation"])
+    parser.add_argument("--batch-sizes", type=str, default=None,
+                        help="Comma separated batch sizes. Defaults to 1,50,100,500 for batching "
+                             "and 1,10,100,10000 otherwise.")
+    args = parser.parse_args()
+
+    rows = read_rows(args.rows)
+    if args.benchmark == "first-request":
+        print(json.dumps(first_request(args.handler, args.model_dir, rows[0])))
+        return
+
+    model_dir = args.model_dir or train_model(os.path.join(tempfile.gettempdir(), "benchmark-model"))
+    if args.benchmark == "cold-start":
+        print_table(benchmark_cold_start(args.handler, model_dir))
+        return
+
+    handler = load_handler(args.handler)
+    model = handler.model_fn(model_dir)
+    default_sizes = "1,50,100,500" if args.benchmark == "batching" else "1,10,100,10000"
+    batch_sizes = [int(b) for b in (args.batch_sizes or default_sizes).split(",")]
+
+    if args.benchmark == "batching":
+        print_table(benchmark_batching(handler, model, rows, args.total_rows, batch_sizes))
+    elif args.benchmark == "formats":
+        print_table(benchmark_formats(handler, model, rows, batch_sizes))
+    elif args.benchmark == "instrumentation":
+        print_table(benchmark_instrumentation(handler, model, rows, batch_sizes))
+    else:
+        print_table(benchmark_predict_modes(handler, model, rows, batch_sizes))
+
+
+if __name__ == "__main__":
+    main()
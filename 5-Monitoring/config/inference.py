@@ -1,10 +1,195 @@
+import atexit
+import json
+import math
 import os
 import pickle
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+from operator import itemgetter
 
+import numpy as np
 import xgboost
-import sagemaker_xgboost_container.encoder as xgb_encoders
 
-# Same as in the training script
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    # The XGBoost container's own decoders, which libsvm bodies are left to
+    import sagemaker_xgboost_container.encoder as xgb_encoders
+except ImportError:
+    xgb_encoders = None
+
+# Width of the feature vector produced by the data preparation lab (label excluded)
+NUM_FEATURES = 69
+
+MODEL_FILE_NAME = "xgboost-model"
+
+# Feature encoding schema written by the preprocessing step and shipped next to the model
+ENCODING_SCHEMA_FILE = "encoding-schema.json"
+ENCODING_SCHEMA_VERSION = 1
+
+# Pickle protocol 2+ streams start with this opcode; native XGBoost formats never do
+_PICKLE_HEADER = b"\x80"
+
+# Set MODEL_WARMUP=false to skip the load-time warm-up prediction
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "true").lower() == "true"
+
+# Threading policy: XGBOOST_NTHREAD pins the thread count; otherwise the cores are split across the
+# model server workers and small requests stay single threaded
+NTHREAD_OVERRIDE = os.environ.get("XGBOOST_NTHREAD")
+MIN_ROWS_PER_THREAD = int(os.environ.get("XGBOOST_MIN_ROWS_PER_THREAD", 256))
+# Per-thread copy of the served booster that predict_array scores requests of another thread count with
+_THREAD_BOOSTERS = threading.local()
+
+# numpy >= 1.23 parses text in C; older releases fall back to a single flat `fromstring` pass
+_C_LOADTXT = np.lib.NumpyVersion(np.__version__) >= "1.23.0"
+_CSV_LINE_BREAKS = bytes.maketrans(b"\r\n", b" ,")
+
+# "inplace" skips building a DMatrix per request; set PREDICT_MODE=dmatrix to force the DMatrix path
+PREDICT_MODE = os.environ.get("PREDICT_MODE", "inplace")
+
+CSV_CONTENT_TYPE = "text/csv"
+NPY_CONTENT_TYPE = "application/x-npy"
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+JSONLINES_CONTENT_TYPE = "application/jsonlines"
+JSON_CONTENT_TYPE = "application/json"
+LIBSVM_CONTENT_TYPE = "text/libsvm"
+
+# Fields output_fn returns unless the Accept header asks otherwise: probability, label or both
+DEFAULT_OUTPUT = os.environ.get("PREDICTION_OUTPUT", "probability")
+DEFAULT_THRESHOLD = float(os.environ.get("PREDICTION_THRESHOLD", 0.5))
+# Digits after the decimal point when probabilities are written as text
+PROBABILITY_DECIMALS = 6
+# An Accept value without parameters gets the response written before they could be given: the
+# default field as str() of each value, one per line, for CSV, and for JSON a bare list of them
+PLAIN_JSON_KEY = None
+
+# Per-stage latency, batch size and payload size histograms, flushed every METRICS_FLUSH_SECONDS as
+# CloudWatch Embedded Metric Format log lines (0 turns the instrumentation off)
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 60))
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SageMakerWorkshop/Inference")
+# The most values CloudWatch accepts in one EMF metric value array
+MAX_EMF_VALUES = 100
+
+# On-demand sampling profiler. PROFILE_SECONDS or PROFILE_REQUESTS profile each worker from start-up,
+# model_fn included. With PROFILE_ON_REQUEST=true, a request whose Content-Type carries "profile=<n>"
+# or "profile=<n>s" starts a run over the next n requests or seconds; otherwise the parameter is
+# ignored. Collapsed stacks are written to PROFILE_DIR, or the model directory when it is unset
+PROFILE_ON_REQUEST = os.environ.get("PROFILE_ON_REQUEST", "false").lower() == "true"
+PROFILE_SECONDS = float(os.environ.get("PROFILE_SECONDS", 0))
+PROFILE_REQUESTS = int(os.environ.get("PROFILE_REQUESTS", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+
+def available_cores():
+    """Number of cores this process may run on, honouring CPU affinity where the platform exposes it."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def model_server_workers(cores):
+    """Workers the model server starts; it defaults to one per core."""
+    return int(os.environ.get("SAGEMAKER_MODEL_SERVER_WORKERS", cores))
+
+
+def choose_nthread(batch_size=None, cores=None, workers=None):
+    """Pick `nthread` for a served booster.
+    Args:
+        batch_size: rows in the request, or None when no request is known yet.
+        cores: detected cores, defaults to available_cores().
+        workers: model server workers, defaults to model_server_workers().
+    Returns:
+        The number of threads the booster should use.
+    """
+    if NTHREAD_OVERRIDE:
+        return int(NTHREAD_OVERRIDE)
+    cores = cores or available_cores()
+    workers = workers or model_server_workers(cores)
+    nthread = max(1, cores // max(1, workers))
+    if batch_size is not None:
+        nthread = min(nthread, max(1, batch_size // MIN_ROWS_PER_THREAD))
+    return nthread
+
+
+def set_nthread(booster, nthread):
+    """
+    Update the booster's thread count only when it changes. Not for the booster model_fn returned
+    once requests score on it, as it is shared: see booster_for.
+    """
+    if getattr(booster, "served_nthread", None) != nthread:
+        booster.set_param('nthread', nthread)
+        booster.served_nthread = nthread
+
+
+def booster_for(booster, nthread):
+    """
+    `booster` itself if it already runs `nthread` threads, otherwise the calling thread's copy of it,
+    with `nthread` rounded down to 1, 2, 4 ... set_param on the booster model_fn returned would change
+    the thread count under every other request scoring on it at the same time. Each thread keeps one
+    copy and only resets its thread count, so there are never more copies than serving threads.
+    """
+    if getattr(booster, "served_nthread", None) == nthread:
+        return booster
+    # Powers of two, so requests of varying sizes do not reset the copy's thread count every time
+    nthread = 1 << (nthread.bit_length() - 1)
+    source, copy = getattr(_THREAD_BOOSTERS, "copy", (None, None))
+    if source is not booster:
+        copy = booster.copy()
+        copy.served_nthread = None
+        _THREAD_BOOSTERS.copy = booster, copy
+    set_nthread(copy, nthread)
+    return copy
+
+
+# find_model_file and load_booster are copied into each handler script (4-Deployment Batch and
+# RealTime, 5-Monitoring, 6-Pipelines), since every one is deployed as a single file: keep them in sync
+def find_model_file(model_dir):
+    """Pick the model artifact deterministically: `xgboost-model` if present, else the first file by name."""
+    if os.path.isfile(os.path.join(model_dir, MODEL_FILE_NAME)):
+        return os.path.join(model_dir, MODEL_FILE_NAME)
+    model_files = sorted(file for file in os.listdir(model_dir)
+                         if not file.startswith(".") and os.path.isfile(os.path.join(model_dir, file)))
+    if not model_files:
+        raise ValueError("No model file found in {}".format(model_dir))
+    return os.path.join(model_dir, model_files[0])
+
+
+def load_booster(model_dir):
+    """Load a booster saved in XGBoost's native binary, JSON or UBJSON format, or a pickled one.
+    The format is detected from the file header, so no load attempt has to fail first.
+    Returns:
+        A XGBoost model.
+        XGBoost model format type.
+    """
+    model_file = find_model_file(model_dir)
+    with open(model_file, "rb") as f:
+        raw = f.read()
+    try:
+        if raw[:1] == _PICKLE_HEADER:
+            return pickle.loads(raw), 'pkl_format'
+        booster = xgboost.Booster()
+        booster.load_model(bytearray(raw))
+        return booster, 'xgb_format'
+    except Exception as e:
+        raise ValueError("Unable to load model {}: {}".format(model_file, str(e)))
+
+
+def warm_up(booster, num_features=NUM_FEATURES):
+    """Run throw-away predictions so the first request does not pay for lazy initialization."""
+    features = np.zeros((1, num_features), dtype=np.float32)
+    booster.predict(xgboost.DMatrix(features))
+    if hasattr(booster, "inplace_predict"):
+        booster.inplace_predict(features)
+
+
+# The model_fn of the 4-Deployment handlers without the prediction cache and micro-batching
 def model_fn(model_dir):
     """Load a model. For XGBoost Framework, a default function to load a model is not provided.
     Users should provide customized model_fn() in script.
@@ -14,58 +199,578 @@ def model_fn(model_dir):
         A XGBoost model.
         XGBoost model format type.
     """
-    model_files = (file for file in os.listdir(model_dir) if os.path.isfile(os.path.join(model_dir, file)))
-    model_file = next(model_files)
+    if PROFILER.output_dir is None:
+        PROFILER.output_dir = model_dir
+    booster, format = load_booster(model_dir)
+    set_nthread(booster, choose_nthread())
+    if MODEL_WARMUP:
+        warm_up(booster)
+    schema_file = os.path.join(model_dir, ENCODING_SCHEMA_FILE)
+    if os.path.exists(schema_file):
+        booster.feature_encoder = FeatureEncoder.load(schema_file)
+    return booster
+
+
+class Histogram(object):
+    """
+    Log-bucketed histogram: bucket i counts values in [lowest * growth**i, lowest * growth**(i + 1)),
+    so recording is one log and one list increment.
+    """
+
+    def __init__(self, lowest, growth=1.25, buckets=100):
+        self.lowest = lowest
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.counts = [0] * buckets
+
+    def record(self, value):
+        bucket = int(math.log(value / self.lowest) / self._log_growth) if value > self.lowest else 0
+        self.counts[min(bucket, len(self.counts) - 1)] += 1
+
+    def to_emf(self):
+        """
+        The recorded values as an EMF metric value, a plain array of numbers: the bucket midpoints
+        (`lowest` for the first), each repeated by its count. EMF takes at most MAX_EMF_VALUES values
+        per metric, so past that the array holds evenly spaced quantiles instead, which keeps the
+        percentiles but caps the sample count CloudWatch sees.
+        """
+        total = sum(self.counts)
+        size = min(total, MAX_EMF_VALUES)
+        values = []
+        bucket, below = 0, self.counts[0]
+        for i in range(size):
+            rank = i * total // size
+            while rank >= below:
+                bucket += 1
+                below += self.counts[bucket]
+            values.append(self.lowest * self.growth ** (bucket + 0.5) if bucket else self.lowest)
+        return values
+
+
+class StageMetrics(object):
+    """
+    In-process histograms of handler stage latencies and sizes. A daemon thread, started lazily in
+    each worker process, swaps the histograms out every flush_seconds and prints them as one
+    CloudWatch Embedded Metric Format line, which CloudWatch Logs turns into metrics.
+    """
+
+    # Smallest value each unit resolves: 1 microsecond, one row, one byte
+    LOWEST = {"Milliseconds": 0.001, "Count": 1, "Bytes": 1}
+
+    def __init__(self, flush_seconds, namespace, dimensions):
+        self.flush_seconds = flush_seconds
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self._histograms = {}
+        self._units = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def record_stage(self, stage, start, size_name, size, size_unit):
+        """Record the time since `start` as `stage`Latency and the size the stage handled."""
+        latency_ms = 1000 * (time.perf_counter() - start)
+        if self._pid != os.getpid():
+            self._start()
+        with self._lock:
+            self._histogram(stage + "Latency", "Milliseconds").record(latency_ms)
+            self._histogram(size_name, size_unit).record(size)
+
+    def _histogram(self, name, unit):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram(self.LOWEST[unit])
+            self._units[name] = unit
+        return histogram
+
+    def _start(self):
+        # Model servers may fork workers after the module is imported, and threads do not survive a fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._histograms = {}
+                threading.Thread(target=self._run, name="stage-metrics", daemon=True).start()
+                atexit.register(self.flush)
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        if not histograms:
+            return
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(self.dimensions)],
+                    "Metrics": [{"Name": name, "Unit": self._units[name]} for name in histograms],
+                }],
+            },
+        }
+        document.update(self.dimensions)
+        document.update((name, histogram.to_emf()) for name, histogram in histograms.items())
+        print(json.dumps(document), flush=True)
+
+
+METRICS = (StageMetrics(METRICS_FLUSH_SECONDS, METRICS_NAMESPACE,
+                        {"Handler": os.path.splitext(os.path.basename(__file__))[0]})
+           if METRICS_FLUSH_SECONDS > 0 else None)
+
+
+class SamplingProfiler(object):
+    """
+    Wall-clock sampling profiler. While a run is active, a background thread records the Python
+    stack of every other thread each interval_ms and, when the run ends, writes the counts in
+    collapsed-stack format ("outer;...;inner count" per line) that flamegraph.pl and speedscope
+    render. Nothing runs between runs; one run per process at a time.
+    """
+
+    # Helper threads whose idle waits would only add noise to the profile
+    IGNORED_THREADS = ("stage-metrics",)
+
+    def __init__(self, interval_ms, output_dir=None):
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self.last_output = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._remaining = 0
+        self._pid = None
+
+    @property
+    def running(self):
+        # A worker forked during a run inherits _thread but not the thread itself
+        return self._thread is not None and self._pid == os.getpid()
+
+    def start(self, seconds=0, requests=0):
+        """Start a run that ends after `seconds`, or after `requests` calls to request_done()."""
+        if seconds <= 0 and requests <= 0:
+            raise ValueError("A profiler run needs a positive number of seconds or requests")
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return False
+            self._pid = os.getpid()
+            self._remaining = requests
+            self._deadline = time.monotonic() + seconds if seconds else None
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        return True
+
+    def request_done(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if self._remaining > 0:
+                self._remaining -= 1
+                if self._remaining == 0:
+                    self._stop.set()
+
+    def _run(self):
+        me = threading.get_ident()
+        started = int(time.time() * 1000)
+        stacks = {}
+        while not self._stop.wait(self.interval):
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                break
+            ignored = {thread.ident for thread in threading.enumerate() if thread.name in self.IGNORED_THREADS}
+            ignored.add(me)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in ignored:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+        try:
+            self._write(stacks, started)
+        finally:
+            with self._lock:
+                self._thread = None
+
+    def _write(self, stacks, started):
+        output_dir = self.output_dir or tempfile.gettempdir()
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, "profile-{}-{}.collapsed".format(os.getpid(), started))
+        with open(path, "w") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+        self.last_output = path
+        print("Wrote {} samples of {} stacks to {}".format(sum(stacks.values()), len(stacks), path), flush=True)
+
+
+def split_profile_request(content_type):
+    """
+    Strip a "profile=<n>" (requests) or "profile=<n>s" (seconds) parameter from a Content-Type value.
+    Returns the remaining content type and the (seconds, requests) of the run it asks for, if any.
+    """
+    params = [param.strip() for param in content_type.split(";")]
+    run = None
+    for param in params[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "profile":
+            value = value.strip().lower()
+            run = (float(value[:-1]), 0) if value.endswith("s") else (0, int(value))
+            params.remove(param)
+            break
+    return "; ".join(params), run
+
+
+PROFILER = SamplingProfiler(PROFILE_INTERVAL_MS, PROFILE_DIR)
+if PROFILE_SECONDS > 0 or PROFILE_REQUESTS > 0:
+    PROFILER.start(PROFILE_SECONDS, PROFILE_REQUESTS)
+
+
+def csv_to_array(request_body, num_features=NUM_FEATURES):
+    """
+    Decode a headerless CSV body straight into a contiguous float32 array of shape
+    (rows, num_features), without building a DataFrame or decoding the body to text.
+    """
+    if isinstance(request_body, str):
+        request_body = request_body.encode("utf-8")
     try:
-        booster = pickle.load(open(os.path.join(model_dir, model_file), 'rb'))
-        format = 'pkl_format'
-    except Exception as exp_pkl:
+        if _C_LOADTXT:
+            # BytesIO shares the request buffer instead of copying it
+            values = np.loadtxt(BytesIO(request_body), delimiter=",", dtype=np.float32, ndmin=2)
+        else:
+            values = np.fromstring(request_body.strip().translate(_CSV_LINE_BREAKS), dtype=np.float32, sep=",")
+    except ValueError as e:
+        raise ValueError("Unable to parse CSV payload: {}".format(str(e)))
+    if values.ndim == 2 and values.size:
+        # loadtxt keeps the rows, so a wrong width cannot hide behind a total size that happens to divide
+        if values.shape[1] != num_features:
+            raise ValueError("Expected {} features per row, got {}".format(num_features, values.shape[1]))
+    elif values.size % num_features != 0:
+        raise ValueError("Expected {} features per row, got {} values in total".format(num_features, values.size))
+    return np.ascontiguousarray(values.reshape(-1, num_features))
+
+
+def npy_to_array(request_body, num_features=NUM_FEATURES):
+    """
+    Decode an .npy body into a float32 feature array. float32 C-ordered payloads are returned
+    as a read-only view of the request buffer; anything else is converted once.
+    """
+    if isinstance(request_body, str):
+        raise ValueError("{} bodies must be sent as bytes".format(NPY_CONTENT_TYPE))
+    buffer = BytesIO(request_body)
+    version = np.lib.format.read_magic(buffer)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(buffer)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(buffer)
+    if dtype.hasobject:
+        raise ValueError("Object arrays are not supported")
+    values = np.frombuffer(request_body, dtype=dtype, count=int(np.prod(shape)), offset=buffer.tell())
+    values = values.reshape(shape, order="F" if fortran_order else "C").reshape(-1, num_features)
+    return np.ascontiguousarray(values, dtype=np.float32)
+
+
+def arrow_to_array(request_body, num_features=NUM_FEATURES):
+    """
+    Decode an Arrow IPC stream with one numeric column per feature into a float32 feature array.
+    """
+    if pa is None:
+        raise ValueError("{} requires pyarrow to be installed".format(ARROW_CONTENT_TYPE))
+    table = pa.ipc.open_stream(pa.py_buffer(request_body)).read_all()
+    if table.num_columns != num_features:
+        raise ValueError("Expected {} feature columns, got {}".format(num_features, table.num_columns))
+    values = np.empty((table.num_rows, num_features), dtype=np.float32)
+    for i, column in enumerate(table.columns):
+        values[:, i] = column.to_numpy()
+    return values
+
+
+class FeatureEncoder(object):
+    """
+    Encodes raw customer records into the model's feature columns, following the encoding schema
+    written by the preprocessing step. Numeric fields are copied into their columns; each
+    categorical field sets the indicator found by a searchsorted lookup in its sorted vocabulary,
+    so a batch costs one array lookup per field. Values outside the vocabulary leave all of the
+    field's indicators at 0, as in preprocessing.
+    """
+
+    def __init__(self, schema):
+        if schema.get("version") != ENCODING_SCHEMA_VERSION:
+            raise ValueError("Unsupported encoding schema version {}".format(schema.get("version")))
+        self.fingerprint = schema.get("fingerprint")
+        self.columns = schema["columns"]
+        position = {column: i for i, column in enumerate(self.columns)}
+        self.numeric_positions = [position[name] for name in schema["numeric"]]
+        self.categorical = []
+        for name, values in schema["categorical"].items():
+            vocabulary = np.sort(np.array([str(value) for value in values]))
+            positions = np.array([position["{}_{}".format(name, value)] for value in vocabulary])
+            self.categorical.append((vocabulary, positions))
+        # One pass over the records pulls out every numeric field, and one more every categorical field
+        self._numeric_fields = itemgetter(*schema["numeric"])
+        self._categorical_fields = itemgetter(*schema["categorical"])
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def encode(self, records):
+        """Encode a list of dicts keyed by the raw column names into a float32 feature array."""
+        features = np.zeros((len(records), len(self.columns)), dtype=np.float32)
+        rows = np.arange(len(records))
+        if not records:
+            return features
         try:
-            booster = xgboost.Booster()
-            booster.load_model(os.path.join(model_dir, model_file))
-            format = 'xgb_format'
-        except Exception as exp_xgb:
-            raise ModelLoadInferenceError("Unable to load model: {} {}".format(str(exp_pkl), str(exp_xgb)))
-    booster.set_param('nthread', 1)
-    return booster
+            numeric = np.array(list(map(self._numeric_fields, records)), dtype=np.float32)
+            categorical = np.array(list(map(self._categorical_fields, records)), dtype=str)
+        except KeyError as e:
+            raise ValueError("Record is missing the {} field".format(e))
+        except TypeError:
+            raise ValueError("Records must be JSON objects keyed by the raw column names")
+        features[:, self.numeric_positions] = numeric.reshape(len(records), -1)
+        for field, (vocabulary, positions) in enumerate(self.categorical):
+            values = categorical.reshape(len(records), -1)[:, field]
+            found = np.minimum(np.searchsorted(vocabulary, values), len(vocabulary) - 1)
+            known = vocabulary[found] == values
+            features[rows[known], positions[found[known]]] = 1
+        return features
+
+
+class RawRecords(list):
+    """Raw customer records decoded from a JSON request, encoded in predict_fn by the model's FeatureEncoder."""
+
+
+def json_to_records(request_body, content_type):
+    """Parse a JSON list of records, {"instances": [...]}, a single record, or one record per JSON Lines line."""
+    if isinstance(request_body, bytes):
+        request_body = request_body.decode("utf-8")
+    if content_type == JSONLINES_CONTENT_TYPE:
+        records = [json.loads(line) for line in request_body.splitlines() if line.strip()]
+    else:
+        records = json.loads(request_body)
+        if isinstance(records, dict):
+            records = records.get("instances", [records])
+    return RawRecords(records)
+
+
+def encode_records(model, records):
+    encoder = getattr(model, "feature_encoder", None)
+    if encoder is None:
+        raise ValueError("Raw records can only be scored when the model artifact has {}".format(ENCODING_SCHEMA_FILE))
+    return encoder.encode(records)
+
+
+def libsvm_to_dmatrix(request_body):
+    """Decode a libsvm body into a DMatrix with the XGBoost container's decoder, as its default input_fn does."""
+    if xgb_encoders is None:
+        raise ValueError("{} bodies need the SageMaker XGBoost container".format(LIBSVM_CONTENT_TYPE))
+    return xgb_encoders.libsvm_to_dmatrix(request_body)
+
+
+def decode_features(request_body, content_type):
+    """
+    Decode a request body of any supported content type into a float32 feature array, or into
+    RawRecords for JSON and JSON Lines bodies of raw customer records, or into a DMatrix for
+    libsvm bodies. Parameters such as "charset=utf-8" do not change the decoder.
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type == CSV_CONTENT_TYPE:
+        return csv_to_array(request_body)
+    elif media_type == NPY_CONTENT_TYPE:
+        return npy_to_array(request_body)
+    elif media_type == ARROW_CONTENT_TYPE:
+        return arrow_to_array(request_body)
+    elif media_type in (JSON_CONTENT_TYPE, JSONLINES_CONTENT_TYPE):
+        return json_to_records(request_body, media_type)
+    elif media_type == LIBSVM_CONTENT_TYPE:
+        return libsvm_to_dmatrix(request_body)
+    else:
+        raise ValueError("Content type {} is not supported.".format(content_type))
+
+
+def parse_accept(accept):
+    """
+    Split an Accept value such as "text/csv; output=both; threshold=0.3; row_id=true" into its
+    media type and the output options for this request. Without parameters, "plain" asks for the
+    response format of the handler before they existed (see PLAIN_JSON_KEY).
+    """
+    media_type, _, params = (accept or CSV_CONTENT_TYPE).partition(";")
+    options = {"output": DEFAULT_OUTPUT, "threshold": DEFAULT_THRESHOLD, "row_id": False,
+               "plain": not params.strip()}
+    for param in params.split(";"):
+        key, _, value = param.partition("=")
+        key, value = key.strip().lower(), value.strip().strip('"')
+        if not key:
+            continue
+        elif key == "output":
+            if value not in ("probability", "label", "both"):
+                raise ValueError("output must be probability, label or both, got {}".format(value))
+            options["output"] = value
+        elif key == "threshold":
+            options["threshold"] = float(value)
+        elif key == "row_id":
+            options["row_id"] = value.lower() in ("true", "1", "yes")
+    return media_type.strip().lower(), options
+
+
+def output_columns(probabilities, options):
+    """Name and values of every field the caller asked for, in output order."""
+    columns = []
+    if options["row_id"]:
+        columns.append(("id", np.arange(len(probabilities))))
+    if options["output"] in ("probability", "both"):
+        columns.append(("probability", probabilities))
+    if options["output"] in ("label", "both"):
+        columns.append(("label", (probabilities >= options["threshold"]).astype(np.uint8)))
+    return columns
+
+
+# The output encoders below are copied into each handler script (4-Deployment Batch and RealTime,
+# 5-Monitoring), since every one is deployed as a single file: keep them in sync
+def _text_column(values, null):
+    """
+    Text of one output field per row: integers as they are, other values with PROBABILITY_DECIMALS
+    decimals, and `null` for NaN or infinite scores.
+    """
+    if values.dtype.kind in "iu":
+        return values.astype(str)
+    text = np.char.mod("%.{}f".format(PROBABILITY_DECIMALS), values.astype(np.float64))
+    return np.where(np.isfinite(values), text, null)
+
+
+def _json_values(values):
+    """The values as a list for json.dumps, with None (null) in place of NaN or infinite scores."""
+    if values.dtype.kind in "iu":
+        return values.tolist()
+    return np.where(np.isfinite(values), values.astype(object), None).tolist()
+
+
+def encode_lines(columns, prefixes, suffix, null):
+    """One line per row, `prefixes[i]` + field i ... + `suffix`, built a column at a time with np.char."""
+    lines = ""
+    for prefix, (_, values) in zip(prefixes, columns):
+        lines = np.char.add(np.char.add(lines, prefix), _text_column(values, null))
+    return "\n".join(np.char.add(lines, suffix).tolist()).encode("utf-8")
+
+
+def encode_plain(values, media_type):
+    """One field as the handler wrote it before Accept parameters: str() per line, or JSON (see PLAIN_JSON_KEY)."""
+    values = values.astype(np.float64).tolist()
+    if media_type == CSV_CONTENT_TYPE:
+        return "\n".join(map(str, values)).encode("utf-8")
+    return json.dumps(values if PLAIN_JSON_KEY is None else {PLAIN_JSON_KEY: values})
+
+
+def encode_predictions(probabilities, accept):
+    """
+    Serialize a 1D array of probabilities as CSV, JSON Lines, JSON, .npy or Arrow. Parameters of
+    the Accept value select the fields and the fixed-decimal text of PROBABILITY_DECIMALS (see
+    parse_accept); CSV and JSON without them are written as before (see PLAIN_JSON_KEY).
+    """
+    media_type, options = parse_accept(accept)
+    columns = output_columns(np.asarray(probabilities), options)
+    rows = len(probabilities)
+    if options["plain"] and len(columns) == 1 and media_type in (CSV_CONTENT_TYPE, JSON_CONTENT_TYPE):
+        return encode_plain(columns[0][1], media_type)
+    if media_type == CSV_CONTENT_TYPE:
+        if rows == 0:
+            return b""
+        prefixes = [""] + [","] * (len(columns) - 1)
+        return encode_lines(columns, prefixes, "", "nan")
+    elif media_type == JSONLINES_CONTENT_TYPE:
+        if rows == 0:
+            return b""
+        prefixes = ['{}"{}":'.format("," if i else "{", name) for i, (name, _) in enumerate(columns)]
+        return encode_lines(columns, prefixes, "}", "null")
+    elif media_type == JSON_CONTENT_TYPE:
+        if len(columns) == 1:
+            return json.dumps({"predictions": _json_values(columns[0][1])})
+        names = [name for name, _ in columns]
+        records = zip(*(_json_values(values) for _, values in columns))
+        return json.dumps({"predictions": [dict(zip(names, record)) for record in records]})
+    elif media_type == NPY_CONTENT_TYPE:
+        values = [values.astype(np.float32) for _, values in columns]
+        buffer = BytesIO()
+        np.save(buffer, values[0] if len(values) == 1 else np.column_stack(values), allow_pickle=False)
+        return buffer.getvalue()
+    elif media_type == ARROW_CONTENT_TYPE:
+        if pa is None:
+            raise ValueError("{} requires pyarrow to be installed".format(ARROW_CONTENT_TYPE))
+        table = pa.table({name: values for name, values in columns})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    else:
+        raise ValueError("Content type {} is not supported.".format(accept))
 
 
 def input_fn(request_body, request_content_type):
     """
     The SageMaker XGBoost model server receives the request data body and the content type,
     and invokes the `input_fn`.
-    The input_fn that just validates request_content_type and prints
+    The input_fn decodes CSV, .npy or Arrow IPC stream bodies into a float32 array.
+    With PROFILE_ON_REQUEST set, a "profile" Content-Type parameter starts a sampling profiler run
+    (see split_profile_request).
     """
-    
-    print("Hello from the PRE-processing function!!!")
-    
-    if request_content_type == "text/csv":
-        return xgb_encoders.csv_to_dmatrix(request_body)
-    else:
-        raise ValueError(
-            "Content type {} is not supported.".format(request_content_type)
-        )
+    start = time.perf_counter()
+    if PROFILE_ON_REQUEST and ";" in request_content_type:
+        request_content_type, profile = split_profile_request(request_content_type)
+        if profile is not None:
+            PROFILER.start(*profile)
+    features = decode_features(request_body, request_content_type)
+    if METRICS is not None:
+        METRICS.record_stage("Input", start, "RequestBytes", len(request_body), "Bytes")
+    return features
+
+
+def predict_array(model, features):
+    """
+    Score a 2D NumPy array, or a DMatrix decoded from a libsvm body. In "inplace" mode the array
+    goes straight to Booster.inplace_predict; otherwise, or if the booster cannot predict in place,
+    it is wrapped in a DMatrix first.
+    """
+    if isinstance(features, xgboost.DMatrix):
+        return booster_for(model, choose_nthread(features.num_row())).predict(features)
+    model = booster_for(model, choose_nthread(len(features)))
+    if PREDICT_MODE == "inplace" and hasattr(model, "inplace_predict"):
+        try:
+            return model.inplace_predict(features)
+        except xgboost.core.XGBoostError:
+            pass
+    return model.predict(xgboost.DMatrix(features))
+
 
 def predict_fn(input_object, model):
     """
     SageMaker XGBoost model server invokes `predict_fn` on the return value of `input_fn`.
+    Every row of the request is scored in a single booster call; raw records are first
+    encoded with the schema loaded in model_fn.
     """
-    return model.predict(input_object)[0]
+    start = time.perf_counter()
+    if isinstance(input_object, RawRecords):
+        input_object = encode_records(model, input_object)
+    prediction = predict_array(model, input_object)
+    if METRICS is not None:
+        METRICS.record_stage("Predict", start, "BatchSize", len(prediction), "Count")
+    return prediction
 
 
 def output_fn(prediction, response_content_type):
     """
     After invoking predict_fn, the model server invokes `output_fn`.
-    An output_fn that just adds a column to the output and validates response_content_type
+    An output_fn that serializes the predictions as CSV (one per line), JSON Lines, JSON, .npy
+    or Arrow and validates response_content_type. Parameters of the Accept value choose between
+    probability, label and both, the label threshold and a row id (see parse_accept).
     """
-    print("Hello from the POST-processing function!!!")
-    
-    appended_output = "hello from pos-processing function!!!"
-    predictions = [prediction, appended_output]
-
-    if response_content_type == "text/csv":
-        csv = ','.join(str(x) for x in predictions)
-        return 
-    else:
-        raise ValueError("Content type {} is not supported.".format(response_content_type))
-    
\ No newline at end of file
+    start = time.perf_counter()
+    response = encode_predictions(prediction, response_content_type)
+    if METRICS is not None:
+        METRICS.record_stage("Output", start, "ResponseBytes", len(response), "Bytes")
+    if PROFILER.running:
+        PROFILER.request_done()
+    return response
@@ -0,0 +1,126 @@
+"""Check the metric lines of inference.py against the CloudWatch Embedded Metric Format.
+
+Records stage latencies and sizes through the handler's StageMetrics, once
+with a few values and once with more than an EMF metric value may hold,
+flushes them and validates each printed document against the EMF
+specification: the _aws metadata, the dimension and metric declarations, and
+every metric value being a number or an array of at most MAX_EMF_VALUES
+numbers. The expanded values must also add up to the recorded distribution
+while they fit in one array.
+
+    python verify_emf.py
+    python verify_emf.py --handler ../../4-Deployment/RealTime/config/xgboost_customer_churn.py
+"""
+import argparse
+import contextlib
+import io
+import json
+import numbers
+import os
+import sys
+import time
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(PATH))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import load_handler
+
+DEFAULT_HANDLER = os.path.join(PATH, "inference.py")
+
+# Limits of the EMF specification
+MAX_DIMENSIONS = 30
+MAX_METRICS = 100
+UNITS = {"Seconds", "Microseconds", "Milliseconds", "Bytes", "Kilobytes", "Megabytes", "Gigabytes",
+         "Terabytes", "Bits", "Kilobits", "Megabits", "Gigabits", "Terabits", "Percent", "Count",
+         "Bytes/Second", "Kilobytes/Second", "Megabytes/Second", "Gigabytes/Second", "Terabytes/Second",
+         "Bits/Second", "Kilobits/Second", "Megabits/Second", "Gigabits/Second", "Terabits/Second",
+         "Count/Second", "None"}
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def emf_errors(document, max_values):
+    """Every way `document` breaks the EMF specification, as messages; empty when it is valid."""
+    errors = []
+    metadata = document.get("_aws")
+    if not isinstance(metadata, dict):
+        return ["no _aws object"]
+    if not isinstance(metadata.get("Timestamp"), int) or isinstance(metadata.get("Timestamp"), bool):
+        errors.append("_aws.Timestamp is not an integer of milliseconds")
+    directives = metadata.get("CloudWatchMetrics")
+    if not isinstance(directives, list) or not directives:
+        return errors + ["_aws.CloudWatchMetrics is not a non-empty array"]
+    for directive in directives:
+        if not isinstance(directive.get("Namespace"), str) or not directive["Namespace"]:
+            errors.append("a directive has no Namespace")
+        for dimension_set in directive.get("Dimensions", []):
+            if not isinstance(dimension_set, list) or len(dimension_set) > MAX_DIMENSIONS:
+                errors.append("dimension set {} is not an array of at most {} names".format(
+                    dimension_set, MAX_DIMENSIONS))
+                continue
+            for name in dimension_set:
+                if not isinstance(document.get(name), str):
+                    errors.append("dimension {} has no string value".format(name))
+        metrics = directive.get("Metrics")
+        if not isinstance(metrics, list) or len(metrics) > MAX_METRICS:
+            errors.append("Metrics is not an array of at most {} definitions".format(MAX_METRICS))
+            continue
+        for metric in metrics:
+            name = metric.get("Name")
+            if metric.get("Unit", "None") not in UNITS:
+                errors.append("metric {} has unit {}".format(name, metric.get("Unit")))
+            value = document.get(name)
+            if is_number(value):
+                continue
+            if not isinstance(value, list) or not value or not all(is_number(v) for v in value):
+                errors.append("metric {} is not a number or an array of numbers: {}".format(
+                    name, json.dumps(value)[:80]))
+            elif len(value) > max_values:
+                errors.append("metric {} has {} values, more than {}".format(name, len(value), max_values))
+    return errors
+
+
+def flush_documents(metrics):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        metrics.flush()
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def check(handler, requests):
+    """Record `requests` requests, flush and return the errors of the documents printed."""
+    metrics = handler.StageMetrics(3600, "Verify", {"Handler": "verify"})
+    for i in range(requests):
+        metrics.record_stage("Predict", time.perf_counter() - 0.001 * (i % 50), "BatchSize", 1 + i % 7, "Count")
+    documents = flush_documents(metrics)
+    errors = []
+    for document in documents:
+        errors += emf_errors(document, handler.MAX_EMF_VALUES)
+        batch_sizes = document.get("BatchSize")
+        if requests <= handler.MAX_EMF_VALUES and isinstance(batch_sizes, list):
+            if len(batch_sizes) != requests:
+                errors.append("{} requests flushed as {} BatchSize values".format(requests, len(batch_sizes)))
+    if len(documents) != 1:
+        errors.append("{} documents printed for one flush".format(len(documents)))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--handler", type=str, default=DEFAULT_HANDLER)
+    args = parser.parse_args()
+
+    handler = load_handler(args.handler)
+    failed = False
+    for requests in [3, handler.MAX_EMF_VALUES, 10 * handler.MAX_EMF_VALUES]:
+        errors = check(handler, requests)
+        print("{} requests: {}".format(requests, "; ".join(errors) if errors else "valid EMF"))
+        failed = failed or bool(errors)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
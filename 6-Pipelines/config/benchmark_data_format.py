@@ -0,0 +1,112 @@
+"""Local benchmark of the CSV and Parquet outputs of preprocess.py.
+
+Encodes synthetic raw churn rows once, writes them as a single train split in
+each format with preprocess.SplitWriter, then reads the split back the way the
+pipeline does: load_channel() of the training script and get_dataset() of
+evaluate.py. Reads run in a fresh process each, so the peak RSS columns are
+the high-water mark of a process that imports the reader and reads the split
+once, libraries included.
+
+    python benchmark_data_format.py --rows 1000000
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(PATH))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import load_script, print_table
+
+SCRIPTS = {
+    "preprocess": os.path.join(PATH, "preprocess.py"),
+    "train": os.path.join(PATH, "xgboost_customer_churn.py"),
+    "evaluate": os.path.join(PATH, "evaluate.py"),
+    "benchmark_preprocess": os.path.join(PATH, "benchmark_preprocess.py"),
+}
+
+
+def make_encoded(rows, chunk_rows=100000):
+    """Encoded churn rows, label first, generated in chunks with the preprocessing benchmark's generator."""
+    preprocess = load_script(SCRIPTS["preprocess"], "preprocess")
+    generator = load_script(SCRIPTS["benchmark_preprocess"], "benchmark_preprocess")
+    chunks = []
+    for seed, start in enumerate(range(0, rows, chunk_rows)):
+        raw = generator.make_shard(preprocess, min(chunk_rows, rows - start), seed).astype(str)
+        chunks.append(preprocess.encode_chunk(raw))
+    return preprocess, pd.concat(chunks, ignore_index=True)
+
+
+def read_split(reader, split_dir):
+    if reader == "train":
+        return load_script(SCRIPTS["train"], "train").load_channel(split_dir).num_row()
+    return len(load_script(SCRIPTS["evaluate"], "evaluate").get_dataset(split_dir, "train"))
+
+
+def _measure_read(reader, split_dir):
+    load_script(SCRIPTS[reader], reader)
+    start = time.perf_counter()
+    rows = read_split(reader, split_dir)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    return rows, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_read(reader, split_dir):
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_measure_read, (reader, split_dir))
+
+
+def benchmark_formats(preprocess, model_data, formats, work_dir):
+    results = []
+    for output_format in formats:
+        base_dir = os.path.join(work_dir, output_format)
+        os.makedirs(os.path.join(base_dir, "train"))
+        for name in preprocess.SPLIT_NAMES[1:]:
+            os.makedirs(os.path.join(base_dir, name))
+
+        start = time.perf_counter()
+        outputs = preprocess.SplitWriter(base_dir, output_format)
+        try:
+            outputs.write("train", model_data)
+        finally:
+            outputs.close()
+        write_seconds = time.perf_counter() - start
+
+        split_dir = os.path.join(base_dir, "train")
+        size = sum(os.path.getsize(os.path.join(split_dir, file)) for file in os.listdir(split_dir))
+        result = {"format": output_format, "megabytes": size / 2 ** 20, "write_sec": write_seconds}
+        for reader in ["train", "evaluate"]:
+            rows, seconds, peak_mb = measure_read(reader, split_dir)
+            assert rows == len(model_data), (reader, rows)
+            result[reader + "_read_sec"] = seconds
+            result[reader + "_peak_rss_mb"] = peak_mb
+        results.append(result)
+        shutil.rmtree(base_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--formats", type=str, default="csv,parquet")
+    args = parser.parse_args()
+
+    preprocess, model_data = make_encoded(args.rows)
+    work_dir = tempfile.mkdtemp(prefix="benchmark-data-format-")
+    try:
+        print_table(benchmark_formats(preprocess, model_data, args.formats.split(","), work_dir))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Local scaling benchmark for sharded preprocessing in preprocess.py.
+
+Writes synthetic raw churn shards to a temporary directory, runs
+preprocess_shards() with 1, 2, 4 ... worker processes and reports rows/sec
+and the speedup over one worker. Every run's splits are checked against the
+single worker run, so the table also shows that adding workers does not move
+rows between train, validation and test.
+
+    python benchmark_preprocess.py --shards 16 --rows-per-shard 100000
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(PATH))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import load_script, print_table
+
+RAW_COLUMNS = [
+    "State", "Account Length", "Area Code", "Phone", "Int'l Plan", "VMail Plan", "VMail Message",
+    "Day Mins", "Day Calls", "Day Charge", "Eve Mins", "Eve Calls", "Eve Charge", "Night Mins",
+    "Night Calls", "Night Charge", "Intl Mins", "Intl Calls", "Intl Charge", "CustServ Calls", "Churn?",
+]
+
+
+def make_shard(preprocess, rows, seed):
+    """Random raw rows in the layout of the churn data set, with every category from the vocabulary."""
+    rng = np.random.default_rng(seed)
+    data = {}
+    for column in RAW_COLUMNS:
+        if column in preprocess.CATEGORIES:
+            values = np.array(preprocess.CATEGORIES[column])
+            data[column] = values[rng.integers(0, len(values), rows)]
+        elif column == "Phone":
+            data[column] = ["{}-{:04d}".format(a, b) for a, b in
+                            zip(rng.integers(100, 1000, rows), rng.integers(0, 10000, rows))]
+        elif column.endswith("Mins") or column.endswith("Charge"):
+            data[column] = rng.uniform(0, 350, rows).round(1)
+        else:
+            data[column] = rng.integers(0, 250, rows)
+    return pd.DataFrame(data, columns=RAW_COLUMNS)
+
+
+def split_digests(preprocess, base_dir):
+    """Order-independent digest of every split, to compare runs that write rows in different orders."""
+    digests = {}
+    for name in preprocess.SPLIT_NAMES:
+        with open(f"{base_dir}/{name}/{name}.csv", "rb") as f:
+            digests[name] = hashlib.sha1(b"".join(sorted(f.read().splitlines(True)))).hexdigest()
+    return digests
+
+
+def benchmark_scaling(preprocess, shards, rows, workers_list, chunk_size, work_dir):
+    results, reference = [], None
+    for workers in workers_list:
+        base_dir = os.path.join(work_dir, "workers-{}".format(workers))
+        for name in ["data"] + preprocess.SPLIT_NAMES:
+            os.makedirs(os.path.join(base_dir, name), exist_ok=True)
+        start = time.perf_counter()
+        preprocess.preprocess_shards(shards, base_dir, chunk_size, workers)
+        seconds = time.perf_counter() - start
+        digests = split_digests(preprocess, base_dir)
+        reference = reference or digests
+        results.append({
+            "workers": workers,
+            "seconds": seconds,
+            "rows_per_sec": rows / seconds,
+            "speedup": results[0]["seconds"] / seconds if results else 1.0,
+            "same_splits": digests == reference,
+        })
+        shutil.rmtree(base_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", type=str, default=os.path.join(PATH, "preprocess.py"))
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--rows-per-shard", type=int, default=50000)
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    parser.add_argument("--workers", type=str, default=None,
+                        help="Comma separated worker counts, defaults to 1, 2, 4 ... up to the core count.")
+    args = parser.parse_args()
+
+    preprocess = load_script(args.script, "preprocess")
+    cores = os.cpu_count()
+    workers_list = [int(w) for w in (args.workers or ",".join(
+        str(1 << i) for i in range(cores.bit_length()) if 1 << i <= cores)).split(",")]
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark-preprocess-")
+    try:
+        shards = []
+        for index in range(args.shards):
+            shard = os.path.join(work_dir, "raw-{:05d}.csv".format(index))
+            make_shard(preprocess, args.rows_per_shard, seed=index).to_csv(shard, index=False)
+            shards.append(shard)
+        print_table(benchmark_scaling(preprocess, shards, args.shards * args.rows_per_shard, workers_list,
+                                      args.chunk_size, work_dir))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
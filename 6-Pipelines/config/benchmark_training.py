@@ -0,0 +1,204 @@
+"""Local benchmarks for the training script xgboost_customer_churn.py.
+
+`external-memory` scales 2-Modeling/config/train.csv up by repeating its rows,
+writes the result as CSV or Parquet shards in a train channel, and trains on it
+once in memory (load_channel) and once per batch size in external-memory mode
+(load_channel_external). Every run happens in a fresh process, so the peak RSS
+column is the high-water mark of one training run, libraries included.
+`tree-method` trains at each --scales size with the exact algorithm, with
+XGBoost's default on a plain DMatrix, and with hist on a QuantileDMatrix built
+by load_channel_quantile. `metrics` trains with the train and validation
+channels as evaluation sets, once per --metrics-modes entry: no metrics
+callback, the smdebug hook of create_smdebug_hook(), and AsyncMetricsCallback.
+
+    python benchmark_training.py --scale 200 --batch-rows 10000,100000
+    python benchmark_training.py --benchmark tree-method --scales 10,50,200
+    python benchmark_training.py --benchmark metrics --scale 10 --num-round 200
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(PATH))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import DEFAULT_TRAIN, TRAINING_PARAMS as PARAMS, load_script, print_table
+
+DEFAULT_SCRIPT = os.path.join(PATH, "xgboost_customer_churn.py")
+
+# (label, tree_method, loader) runs of the tree-method benchmark
+TREE_METHOD_RUNS = [
+    ("exact", "exact", "memory"),
+    ("default", None, "memory"),
+    ("hist/quantile", "hist", "quantile"),
+]
+
+
+def write_channel(channel_dir, train_path, scale, shards, data_format):
+    """Write train.csv repeated `scale` times as `shards` files; returns the number of rows."""
+    data = np.loadtxt(train_path, delimiter=",", dtype=np.float32)
+    data = np.tile(data, (scale, 1))
+    os.makedirs(channel_dir)
+    for index, part in enumerate(np.array_split(data, shards)):
+        path = os.path.join(channel_dir, "train-{:05d}.{}".format(index, data_format))
+        if data_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            pq.write_table(pa.table({"c{}".format(i): part[:, i] for i in range(part.shape[1])}), path)
+        else:
+            np.savetxt(path, part, delimiter=",", fmt="%g")
+    return len(data)
+
+
+def _train(script_path, channel_dir, loader, batch_rows, num_round, tree_method="hist", max_bin=256):
+    training = load_script(script_path, "training")
+    params = dict(PARAMS, max_bin=max_bin)
+    if tree_method:
+        params["tree_method"] = tree_method
+    start = time.perf_counter()
+    cache_dir = tempfile.mkdtemp(prefix="benchmark-cache-")
+    try:
+        if loader == "external":
+            dtrain = training.load_channel_external(channel_dir, batch_rows, cache_dir)
+        elif loader == "quantile":
+            dtrain = training.load_channel_quantile(channel_dir, batch_rows, max_bin)
+        else:
+            dtrain = training.load_channel(channel_dir)
+        load_seconds = time.perf_counter() - start
+        training.xgboost.train(params, dtrain, num_boost_round=num_round)
+    finally:
+        shutil.rmtree(cache_dir)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    return load_seconds, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _train_with_metrics(script_path, channel_dir, num_round, metrics_mode, output_dir):
+    training = load_script(script_path, "training")
+    dtrain = training.load_channel(channel_dir)
+    dval = training.load_channel(channel_dir)
+    callbacks = []
+    if metrics_mode == "smdebug":
+        callbacks.append(training.create_smdebug_hook(out_dir=output_dir, collections=["metrics"],
+                                                      train_data=dtrain, validation_data=dval))
+    elif metrics_mode == "callback":
+        callbacks.append(training.AsyncMetricsCallback(os.path.join(output_dir, "metrics.jsonl")))
+    start = time.perf_counter()
+    training.xgboost.train(dict(PARAMS, tree_method="hist"), dtrain, num_boost_round=num_round,
+                           evals=[(dtrain, "train"), (dval, "validation")], verbose_eval=False, callbacks=callbacks)
+    return time.perf_counter() - start
+
+
+def run_isolated(function, *args):
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def benchmark_external_memory(script_path, channel_dir, rows, batch_rows_list, num_round):
+    results = []
+    for batch_rows in [0] + batch_rows_list:
+        loader = "external" if batch_rows else "memory"
+        load_seconds, seconds, peak_mb = run_isolated(_train, script_path, channel_dir, loader, batch_rows,
+                                                      num_round)
+        results.append({
+            "mode": "external/{}".format(batch_rows) if batch_rows else "in-memory",
+            "rows": rows,
+            "load_sec": load_seconds,
+            "total_sec": seconds,
+            "peak_rss_mb": peak_mb,
+        })
+    return results
+
+
+def benchmark_tree_method(script_path, work_dir, args):
+    results = []
+    for scale in [int(s) for s in args.scales.split(",")]:
+        channel_dir = os.path.join(work_dir, "train-x{}".format(scale))
+        rows = write_channel(channel_dir, args.train, scale, args.shards, args.format)
+        for label, tree_method, loader in TREE_METHOD_RUNS:
+            load_seconds, seconds, peak_mb = run_isolated(
+                _train, script_path, channel_dir, loader, args.quantile_batch_rows, args.num_round,
+                tree_method, args.max_bin)
+            results.append({
+                "mode": label,
+                "rows": rows,
+                "load_sec": load_seconds,
+                "total_sec": seconds,
+                "peak_rss_mb": peak_mb,
+            })
+        shutil.rmtree(channel_dir)
+    return results
+
+
+def benchmark_metrics(script_path, channel_dir, rows, metrics_modes, num_round, repeat, work_dir):
+    results = []
+    for metrics_mode in metrics_modes:
+        seconds = []
+        for _ in range(repeat):
+            output_dir = tempfile.mkdtemp(prefix="metrics-", dir=work_dir)
+            seconds.append(run_isolated(_train_with_metrics, script_path, channel_dir, num_round, metrics_mode,
+                                        output_dir))
+            shutil.rmtree(output_dir)
+        results.append({
+            "metrics": metrics_mode,
+            "rows": rows,
+            "rounds": num_round,
+            "train_sec": float(np.median(seconds)),
+            "sec_per_round": float(np.median(seconds)) / num_round,
+        })
+    for result in results:
+        result["overhead"] = result["train_sec"] / results[0]["train_sec"] - 1
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", choices=["external-memory", "tree-method", "metrics"],
+                        default="external-memory")
+    parser.add_argument("--script", type=str, default=DEFAULT_SCRIPT)
+    parser.add_argument("--train", type=str, default=DEFAULT_TRAIN)
+    parser.add_argument("--scale", type=int, default=200,
+                        help="Times the rows of --train are repeated.")
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--format", type=str, choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--batch-rows", type=str, default="10000,100000",
+                        help="Comma separated external-memory batch sizes.")
+    parser.add_argument("--scales", type=str, default="10,50,200",
+                        help="Comma separated --scale values of the tree-method benchmark.")
+    parser.add_argument("--max-bin", type=int, default=256)
+    parser.add_argument("--quantile-batch-rows", type=int, default=100000)
+    parser.add_argument("--metrics-modes", type=str, default="none,smdebug,callback")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per metrics mode; the median is reported.")
+    parser.add_argument("--num-round", type=int, default=50)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark-training-")
+    try:
+        if args.benchmark == "tree-method":
+            print_table(benchmark_tree_method(args.script, work_dir, args))
+        elif args.benchmark == "metrics":
+            channel_dir = os.path.join(work_dir, "train")
+            rows = write_channel(channel_dir, args.train, args.scale, args.shards, args.format)
+            print_table(benchmark_metrics(args.script, channel_dir, rows, args.metrics_modes.split(","),
+                                          args.num_round, args.repeat, work_dir))
+        else:
+            channel_dir = os.path.join(work_dir, "train")
+            rows = write_channel(channel_dir, args.train, args.scale, args.shards, args.format)
+            batch_rows_list = [int(b) for b in args.batch_rows.split(",")]
+            print_table(benchmark_external_memory(args.script, channel_dir, rows, batch_rows_list,
+                                                  args.num_round))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
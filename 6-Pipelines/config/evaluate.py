@@ -17,6 +17,18 @@ logger.addHandler(logging.StreamHandler())
 # See https://docs.aws.amazon.com/sagemaker/latest/dg/model-monitor-model-quality-metrics.html
 from sklearn.metrics import classification_report, roc_auc_score, accuracy_score
 
+
+def load_model(model_file):
+    """Load a booster saved in XGBoost's native format, or a pickled one from older training jobs."""
+    with open(model_file, "rb") as f:
+        raw = f.read()
+    if raw[:1] == b"\x80":  # pickle protocol 2+ header
+        return pickle.loads(raw)
+    model = xgboost.Booster()
+    model.load_model(bytearray(raw))
+    return model
+
+
 def get_dataset(dir_path, dataset_name) -> pd.DataFrame:
     files = [ os.path.join(dir_path, file) for file in os.listdir(dir_path) ]
     if len(files) == 0:
@@ -24,7 +36,9 @@ def get_dataset(dir_path, dataset_name) -> pd.DataFrame:
                           'This usually indicates that the channel ({}) was incorrectly specified,\n' +
                           'the data specification in S3 was incorrectly specified or the role specified\n' +
                           'does not have permission to access the data.').format(files, dataset_name))
-    raw_data = [ pd.read_csv(file, header=None) for file in files ]
+    # Parquet outputs of preprocess.py keep their compact column types; CSV outputs are parsed as text
+    raw_data = [ pd.read_parquet(file) if file.endswith(".parquet") else pd.read_csv(file, header=None)
+                 for file in sorted(files) ]
     df = pd.concat(raw_data)
     return df
 
@@ -34,7 +48,7 @@ if __name__ == "__main__":
         tar.extractall(path="..")
 
     logger.debug("Loading xgboost model.")
-    model = pickle.load(open("xgboost-model", "rb"))
+    model = load_model("xgboost-model")
 
     logger.info("Loading test input data")
     test_path = "/opt/ml/processing/test"
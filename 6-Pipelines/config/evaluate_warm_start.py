@@ -0,0 +1,128 @@
+"""Compare warm-start retraining with a full retrain of xgboost_customer_churn.py.
+
+Splits the 2-Modeling train set into history and newly arrived rows (the last
+--new-fraction), repeats both --scale times, and trains:
+
+1. a base model on the history, for --num-round rounds;
+2. a full retrain on history and new rows, for --num-round rounds;
+3. per --warm-start-rounds value, a warm start from the base model's
+   model.tar.gz in the base_model channel, on the new rows only.
+
+Every run calls the script's main() in a fresh process and is timed around it.
+The table has the training time and the AUC of each model on the 2-Modeling
+test set. Unknown arguments are passed to every run as hyperparameters.
+
+    python evaluate_warm_start.py --scale 20 --warm-start-rounds 5,10,25
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(PATH))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import load_script, print_table
+
+DEFAULT_SCRIPT = os.path.join(PATH, "xgboost_customer_churn.py")
+DATA_DIR = os.path.join(REPO_ROOT, "2-Modeling", "config")
+
+
+def write_channel(channel_dir, data):
+    os.makedirs(channel_dir)
+    np.savetxt(os.path.join(channel_dir, "train.csv"), data, delimiter=",", fmt="%g")
+
+
+def _run_training(script_path, model_dir, argv):
+    os.environ["SM_MODEL_DIR"] = model_dir
+    sys.argv = [script_path] + argv
+    training = load_script(script_path, "training")
+    start = time.perf_counter()
+    training.main()
+    return time.perf_counter() - start
+
+
+def run_training(script_path, model_dir, argv):
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_run_training, (script_path, model_dir, argv))
+
+
+def test_auc(model_dir, test_path):
+    import xgboost
+    from sklearn.metrics import roc_auc_score
+    data = np.loadtxt(test_path, delimiter=",", dtype=np.float32)
+    booster = xgboost.Booster(model_file=os.path.join(model_dir, "xgboost-model"))
+    return float(roc_auc_score(data[:, 0], booster.predict(xgboost.DMatrix(data[:, 1:]))))
+
+
+def package_model(model_dir, channel_dir):
+    """The model directory as the model.tar.gz a SageMaker training job uploads."""
+    os.makedirs(channel_dir)
+    with tarfile.open(os.path.join(channel_dir, "model.tar.gz"), "w:gz") as tar:
+        for file in sorted(os.listdir(model_dir)):
+            tar.add(os.path.join(model_dir, file), arcname=file)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", type=str, default=DEFAULT_SCRIPT)
+    parser.add_argument("--scale", type=int, default=20,
+                        help="Times the history and the new rows are repeated.")
+    parser.add_argument("--new-fraction", type=float, default=0.2)
+    parser.add_argument("--num-round", type=int, default=50)
+    parser.add_argument("--warm-start-rounds", type=str, default="5,10,25",
+                        help="Comma separated rounds added by the warm starts.")
+    args, hyperparameters = parser.parse_known_args()
+
+    data = np.loadtxt(os.path.join(DATA_DIR, "train.csv"), delimiter=",", dtype=np.float32)
+    split = int(len(data) * (1 - args.new_fraction))
+    history, new = np.tile(data[:split], (args.scale, 1)), np.tile(data[split:], (args.scale, 1))
+
+    work_dir = tempfile.mkdtemp(prefix="evaluate-warm-start-")
+    try:
+        channel_rows = {"history": history, "all": np.vstack([history, new]), "new": new}
+        for name, rows in channel_rows.items():
+            write_channel(os.path.join(work_dir, name), rows)
+        os.makedirs(os.path.join(work_dir, "validation"))
+        shutil.copy(os.path.join(DATA_DIR, "validation.csv"), os.path.join(work_dir, "validation"))
+        common = ["--validation", os.path.join(work_dir, "validation"), "--metrics_mode", "none",
+                  "--output_uri", os.path.join(work_dir, "tensors")] + hyperparameters
+        runs = [("base (history)", "history", args.num_round, []),
+                ("full retrain", "all", args.num_round, [])]
+        runs += [("warm start +{}".format(rounds), "new", rounds,
+                  ["--base_model", os.path.join(work_dir, "base-channel"), "--warm_start_rounds", str(rounds)])
+                 for rounds in [int(r) for r in args.warm_start_rounds.split(",")]]
+
+        results = []
+        for index, (label, channel, rounds, extra) in enumerate(runs):
+            model_dir = os.path.join(work_dir, "model-{}".format(index))
+            argv = ["--train", os.path.join(work_dir, channel), "--num_round", str(args.num_round)] + common + extra
+            seconds = run_training(args.script, model_dir, argv)
+            if index == 0:
+                package_model(model_dir, os.path.join(work_dir, "base-channel"))
+            with open(os.path.join(model_dir, "lineage.json")) as f:
+                lineage = json.load(f)
+            results.append({
+                "run": label,
+                "train_rows": len(channel_rows[channel]),
+                "rounds_trained": rounds,
+                "total_rounds": lineage["rounds"],
+                "train_sec": seconds,
+                "test_auc": test_auc(model_dir, os.path.join(DATA_DIR, "test.csv")),
+                "parent": (lineage["parent"] or {}).get("model_sha256", "")[:12],
+            })
+        print_table(results)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,165 @@
 """Feature engineers the customer churn dataset."""
 import argparse
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
 import pathlib
+import shutil
 
 import boto3
 import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
-if __name__ == "__main__":
-    logger.info("Starting preprocessing.")
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input-data", type=str, required=True)
-    args = parser.parse_args()
+DROP_COLUMNS = ["Phone", "Day Charge", "Eve Charge", "Night Charge", "Intl Charge"]
+NUMERIC_COLUMNS = [
+    "Account Length", "VMail Message", "Day Mins", "Day Calls", "Eve Mins", "Eve Calls",
+    "Night Mins", "Night Calls", "Intl Mins", "Intl Calls", "CustServ Calls",
+]
+LABEL_COLUMN = "Churn?"
+POSITIVE_LABEL = "True."
 
-    base_dir = "/opt/ml/processing"
-    pathlib.Path(f"{base_dir}/data").mkdir(parents=True, exist_ok=True)
-    input_data = args.input_data
-    print(input_data)
-    bucket = input_data.split("/")[2]
-    key = "/".join(input_data.split("/")[3:])
+# Category vocabulary of the raw churn data. Encoding every chunk against it gives the same one-hot
+# columns as pd.get_dummies on the whole file, whichever values a chunk happens to contain
+CATEGORIES = {
+    "State": [
+        "AK", "AL", "AR", "AZ", "CA", "CO", "CT", "DC", "DE", "FL", "GA", "HI", "IA", "ID", "IL", "IN",
+        "KS", "KY", "LA", "MA", "MD", "ME", "MI", "MN", "MO", "MS", "MT", "NC", "ND", "NE", "NH", "NJ",
+        "NM", "NV", "NY", "OH", "OK", "OR", "PA", "RI", "SC", "SD", "TN", "TX", "UT", "VA", "VT", "WA",
+        "WI", "WV", "WY",
+    ],
+    "Area Code": ["408", "415", "510"],
+    "Int'l Plan": ["no", "yes"],
+    "VMail Plan": ["no", "yes"],
+    "Churn?": ["False.", "True."],
+}
+
+# Upper bounds of the train and validation buckets out of SPLIT_BUCKETS: 70/20/10
+SPLIT_BUCKETS = 10000
+SPLIT_BOUNDS = [7000, 9000]
+SPLIT_NAMES = ["train", "validation", "test"]
+
+# Rows per chunk when sharded input is streamed without an explicit --chunk-size
+DEFAULT_CHUNK_SIZE = 100000
+
+# "csv" writes headerless text as before; "parquet" writes typed columns: a uint8 label and uint8 one-hot
+# columns next to float32 numeric columns, the precision XGBoost trains at anyway
+OUTPUT_FORMATS = ["csv", "parquet"]
+
+# Bump when the layout of the encoding schema file changes
+ENCODING_SCHEMA_VERSION = 1
+ENCODING_SCHEMA_FILE = "encoding-schema.json"
+
+
+def build_encoding_schema():
+    """
+    Describe the feature encoding: the raw columns used, the category vocabularies and the order of
+    the encoded feature columns (label excluded). The serving handlers load this file to encode raw
+    customer records into exactly the columns the model was trained on.
+    """
+    categorical = {name: values for name, values in CATEGORIES.items() if name != LABEL_COLUMN}
+    schema = {
+        "version": ENCODING_SCHEMA_VERSION,
+        "label": {"column": LABEL_COLUMN, "positive": POSITIVE_LABEL},
+        "drop": DROP_COLUMNS,
+        "numeric": NUMERIC_COLUMNS,
+        "categorical": categorical,
+        "columns": NUMERIC_COLUMNS + ["{}_{}".format(name, value)
+                                      for name, values in categorical.items() for value in values],
+    }
+    schema["fingerprint"] = hashlib.sha1(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+    return schema
+
+
+def write_encoding_schema(output_dir):
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    schema = build_encoding_schema()
+    with open(f"{output_dir}/{ENCODING_SCHEMA_FILE}", "w") as f:
+        json.dump(schema, f, indent=2)
+    logger.info("Wrote encoding schema %s with %d feature columns.", schema["fingerprint"], len(schema["columns"]))
+    return schema
+
+
+def encode_chunk(raw):
+    """Apply the drops and the fixed-vocabulary one-hot encoding to a chunk of raw rows read as text."""
+    df = raw.drop(DROP_COLUMNS, axis=1)
+    for column in df.columns:
+        if column in CATEGORIES:
+            values = df[column]
+            df[column] = pd.Categorical(values, categories=CATEGORIES[column])
+            unknown = df[column].isna() & values.notna()
+            if unknown.any():
+                logger.warning("%d rows have a %s outside the vocabulary: %s", unknown.sum(), column,
+                               sorted(values[unknown].unique()))
+        else:
+            df[column] = pd.to_numeric(df[column])
+
+    model_data = pd.get_dummies(df, dtype=np.uint8)
+    return pd.concat(
+        [
+            model_data["Churn?_True."],
+            model_data.drop(["Churn?_False.", "Churn?_True."], axis=1),
+        ],
+        axis=1,
+    )
+
+
+def parquet_schema():
+    """Arrow schema of the encoded Parquet outputs: label first, then the encoding schema's columns."""
+    return pa.schema(
+        [pa.field("Churn?_True.", pa.uint8())]
+        + [pa.field(column, pa.float32() if column in NUMERIC_COLUMNS else pa.uint8())
+           for column in build_encoding_schema()["columns"]]
+    )
+
+
+class SplitWriter:
+    """Appends encoded rows to one output file per split, as headerless CSV or as Parquet."""
+
+    def __init__(self, base_dir, output_format="csv", output_suffix=""):
+        if output_format == "parquet" and pq is None:
+            raise ImportError("pyarrow is required to write Parquet outputs")
+        self.output_format = output_format
+        self.schema = parquet_schema() if output_format == "parquet" else None
+        self.outputs = {}
+        for name in SPLIT_NAMES:
+            path = f"{base_dir}/{name}/{name}{output_suffix}.{output_format}"
+            self.outputs[name] = pq.ParquetWriter(path, self.schema) if self.schema else open(path, "w")
+
+    def write(self, name, rows):
+        if self.schema is None:
+            rows.to_csv(self.outputs[name], header=False, index=False)
+        else:
+            rows = rows.astype({field.name: field.type.to_pandas_dtype() for field in self.schema})
+            self.outputs[name].write_table(pa.Table.from_pandas(rows, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        for output in self.outputs.values():
+            output.close()
+
+
+def split_assignment(raw):
+    """
+    Split index (0 train, 1 validation, 2 test) of every row, from a hash of its raw values, so a
+    row lands in the same split whichever chunk it is read in.
+    """
+    buckets = pd.util.hash_pandas_object(raw, index=False).values % SPLIT_BUCKETS
+    return np.searchsorted(SPLIT_BOUNDS, buckets, side="right")
 
-    logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
-    fn = f"{base_dir}/data/raw-data.csv"
-    s3 = boto3.resource("s3")
-    s3.Bucket(bucket).download_file(key, fn)
 
+def preprocess_whole_file(fn, base_dir, output_format="csv"):
+    """Encode the whole raw file in memory and split it with a seeded global shuffle."""
     logger.info("Reading downloaded data.")
 
     # read in csv
@@ -43,8 +174,8 @@ if __name__ == "__main__":
     # Drop several other columns
     df = df.drop(["Day Charge", "Eve Charge", "Night Charge", "Intl Charge"], axis=1)
 
-    # Convert categorical variables into dummy/indicator variables.
-    model_data = pd.get_dummies(df)
+    # Convert categorical variables into 0/1 dummy/indicator variables, as encode_chunk does
+    model_data = pd.get_dummies(df, dtype=np.uint8)
 
     # Create one binary classification target column
     model_data = pd.concat(
@@ -55,18 +186,166 @@ if __name__ == "__main__":
         axis=1,
     )
 
-    # Split the data
-    train_data, validation_data, test_data = np.split(
-        model_data.sample(frac=1, random_state=1729),
-        [int(0.7 * len(model_data)), int(0.9 * len(model_data))],
-    )
+    # Lay the columns out as in the encoding schema, whichever categories appear in this file
+    model_data = model_data.reindex(columns=["Churn?_True."] + build_encoding_schema()["columns"], fill_value=0)
 
-    pd.DataFrame(train_data).to_csv(
-        f"{base_dir}/train/train.csv", header=False, index=False
-    )
-    pd.DataFrame(validation_data).to_csv(
-        f"{base_dir}/validation/validation.csv", header=False, index=False
-    )
-    pd.DataFrame(test_data).to_csv(
-        f"{base_dir}/test/test.csv", header=False, index=False
-    )
+    # Split the data; iloc slices keep the column dtypes, where np.split may return a float array
+    shuffled = model_data.sample(frac=1, random_state=1729)
+    train_end, validation_end = int(0.7 * len(model_data)), int(0.9 * len(model_data))
+    train_data = shuffled.iloc[:train_end]
+    validation_data = shuffled.iloc[train_end:validation_end]
+    test_data = shuffled.iloc[validation_end:]
+
+    outputs = SplitWriter(base_dir, output_format)
+    try:
+        for name, rows in zip(SPLIT_NAMES, [train_data, validation_data, test_data]):
+            outputs.write(name, rows)
+    finally:
+        outputs.close()
+
+
+def preprocess_stream(fn, base_dir, chunk_size, output_suffix="", output_format="csv"):
+    """Encode and split the raw file `chunk_size` rows at a time, appending each chunk to the outputs."""
+    outputs = SplitWriter(base_dir, output_format, output_suffix)
+    counts = dict.fromkeys(SPLIT_NAMES, 0)
+    try:
+        for raw in pd.read_csv(fn, dtype=str, chunksize=chunk_size):
+            model_data = encode_chunk(raw)
+            assignment = split_assignment(raw)
+            for index, name in enumerate(SPLIT_NAMES):
+                rows = model_data[assignment == index]
+                outputs.write(name, rows)
+                counts[name] += len(rows)
+    finally:
+        outputs.close()
+    return counts
+
+
+def log_split(counts):
+    total = sum(counts.values())
+    logger.info("Split %d rows: %s", total,
+                ", ".join("{} {:.1%}".format(name, counts[name] / max(total, 1)) for name in SPLIT_NAMES))
+
+
+def list_shards(input_data):
+    """
+    Input files in a stable order: the S3 object or local file given, or every object under an
+    S3 prefix or every file in a local directory.
+    """
+    if input_data.startswith("s3://"):
+        bucket, _, prefix = input_data[len("s3://"):].partition("/")
+        keys = sorted(obj.key for obj in boto3.resource("s3").Bucket(bucket).objects.filter(Prefix=prefix)
+                      if not obj.key.endswith("/"))
+        if prefix in keys:
+            keys = [prefix]
+        return [f"s3://{bucket}/{key}" for key in keys]
+    if os.path.isdir(input_data):
+        return sorted(str(path) for path in pathlib.Path(input_data).iterdir() if path.is_file())
+    return [input_data]
+
+
+def fetch_shard(shard, fn):
+    """Local path of a shard, downloading it to `fn` first when it is on S3."""
+    if not shard.startswith("s3://"):
+        return shard
+    bucket = shard.split("/")[2]
+    key = "/".join(shard.split("/")[3:])
+    logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
+    boto3.resource("s3").Bucket(bucket).download_file(key, fn)
+    return fn
+
+
+def processing_hosts():
+    """All hosts of the processing job and the one this process runs on, from the SageMaker resource config."""
+    try:
+        with open("/opt/ml/config/resourceconfig.json") as f:
+            config = json.load(f)
+        return sorted(config["hosts"]), config["current_host"]
+    except (OSError, ValueError, KeyError):
+        return ["localhost"], "localhost"
+
+
+def assign_shards(shards, hosts, current_host):
+    """Shards this host processes: every len(hosts)-th shard, starting at the host's index."""
+    return shards[hosts.index(current_host)::len(hosts)]
+
+
+def _process_shard(task):
+    index, shard, base_dir, chunk_size, output_format = task
+    fn = fetch_shard(shard, f"{base_dir}/data/shard-{index:05d}.csv")
+    try:
+        return preprocess_stream(fn, base_dir, chunk_size, f"-part-{index:05d}", output_format)
+    finally:
+        if fn != shard:
+            os.remove(fn)
+
+
+def preprocess_shards(shards, base_dir, chunk_size, workers, output_suffix="", output_format="csv"):
+    """
+    Stream every shard through a pool of `workers` processes, each writing its own part files,
+    then concatenate the parts of each split in shard order. Rows are assigned to splits by their
+    hash, so the splits are the same as processing all shards in one process. Parquet parts are
+    kept as one file per shard, since the readers take every file in a channel.
+    """
+    tasks = [(index, shard, base_dir, chunk_size, output_format) for index, shard in enumerate(shards)]
+    counts = dict.fromkeys(SPLIT_NAMES, 0)
+    with multiprocessing.Pool(min(workers, len(tasks)) or 1) as pool:
+        for shard_counts in pool.imap(_process_shard, tasks):
+            for name in SPLIT_NAMES:
+                counts[name] += shard_counts[name]
+
+    for name in SPLIT_NAMES:
+        if output_format == "parquet":
+            for index in range(len(tasks)):
+                os.replace(f"{base_dir}/{name}/{name}-part-{index:05d}.parquet",
+                           f"{base_dir}/{name}/{name}{output_suffix}-{index:05d}.parquet")
+            continue
+        with open(f"{base_dir}/{name}/{name}{output_suffix}.csv", "wb") as output:
+            for index in range(len(tasks)):
+                part = f"{base_dir}/{name}/{name}-part-{index:05d}.csv"
+                with open(part, "rb") as f:
+                    shutil.copyfileobj(f, output)
+                os.remove(part)
+    return counts
+
+
+if __name__ == "__main__":
+    logger.info("Starting preprocessing.")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-data", type=str, required=True,
+                        help="S3 URI or local path of the raw CSV, or of a prefix or directory of CSV shards.")
+    parser.add_argument("--chunk-size", type=int, default=0,
+                        help="Rows per chunk in streaming mode; 0 loads the whole file at once. "
+                             "Sharded input is always streamed, in chunks of DEFAULT_CHUNK_SIZE rows if 0.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Processes per instance working on sharded input.")
+    parser.add_argument("--output-format", type=str, choices=OUTPUT_FORMATS, default="csv",
+                        help="File format of the train, validation and test outputs.")
+    parser.add_argument("--base-dir", type=str, default="/opt/ml/processing")
+    args = parser.parse_args()
+
+    base_dir = args.base_dir
+    pathlib.Path(f"{base_dir}/data").mkdir(parents=True, exist_ok=True)
+    input_data = args.input_data
+    print(input_data)
+    shards = list_shards(input_data)
+    hosts, current_host = processing_hosts()
+
+    write_encoding_schema(f"{base_dir}/schema")
+    for name in SPLIT_NAMES:
+        pathlib.Path(f"{base_dir}/{name}").mkdir(parents=True, exist_ok=True)
+
+    if len(shards) > 1 or len(hosts) > 1:
+        shards = assign_shards(shards, hosts, current_host)
+        logger.info("Processing %d shards on %s with %d workers.", len(shards), current_host, args.workers)
+        # Every instance uploads to the same output prefixes, so the files are named after the host
+        output_suffix = f"-{current_host}" if len(hosts) > 1 else ""
+        log_split(preprocess_shards(shards, base_dir, args.chunk_size or DEFAULT_CHUNK_SIZE, args.workers,
+                                    output_suffix, args.output_format))
+    else:
+        fn = fetch_shard(shards[0], f"{base_dir}/data/raw-data.csv")
+        if args.chunk_size > 0:
+            logger.info("Streaming data in chunks of %d rows.", args.chunk_size)
+            log_split(preprocess_stream(fn, base_dir, args.chunk_size, output_format=args.output_format))
+        else:
+            preprocess_whole_file(fn, base_dir, args.output_format)
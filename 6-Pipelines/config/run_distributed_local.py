@@ -0,0 +1,70 @@
+"""Run xgboost_customer_churn.py as a distributed training job on one Linux box.
+
+Starts --workers training processes with the environment SageMaker gives the
+hosts of a multi-instance job: SM_HOSTS lists one loopback address per worker
+(127.0.0.1, 127.0.0.2 ...), which all reach this machine, and SM_CURRENT_HOST
+names the worker's own. Every worker gets its own model and debugger output
+directory, so the run shows that only the leader writes them. Arguments the
+launcher does not know are passed to the training script as hyperparameters.
+
+    python run_distributed_local.py --workers 3 --train data/train --validation data/validation --num_round 20
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    """A port nothing listens on, so back-to-back runs do not collide with a tracker port in TIME_WAIT."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def launch_workers(script, workers, train, validation, work_dir, hyperparameters):
+    hosts = ["127.0.0.{}".format(index + 1) for index in range(workers)]
+    tracker_port = str(free_port())
+    processes = []
+    for host in hosts:
+        worker_dir = os.path.join(work_dir, host)
+        env = dict(os.environ,
+                   SM_HOSTS=json.dumps(hosts),
+                   SM_CURRENT_HOST=host,
+                   SM_MODEL_DIR=os.path.join(worker_dir, "model"))
+        command = [sys.executable, script, "--train", train, "--validation", validation,
+                   "--output_uri", os.path.join(worker_dir, "tensors"),
+                   "--tracker_port", tracker_port] + hyperparameters
+        processes.append((host, subprocess.Popen(command, env=env)))
+    return [(host, process.wait()) for host, process in processes]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", type=str, default=os.path.join(PATH, "xgboost_customer_churn.py"))
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--train", type=str, required=True)
+    parser.add_argument("--validation", type=str, required=True)
+    parser.add_argument("--work-dir", type=str, default=None,
+                        help="Directory for the workers' outputs, a new temporary directory if unset.")
+    args, hyperparameters = parser.parse_known_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="distributed-training-")
+    results = launch_workers(args.script, args.workers, args.train, args.validation, work_dir, hyperparameters)
+    for host, returncode in results:
+        worker_dir = os.path.join(work_dir, host)
+        written = sorted(name for name in ["model", "tensors"]
+                         if os.path.isdir(os.path.join(worker_dir, name))
+                         and os.listdir(os.path.join(worker_dir, name)))
+        print("{:>12}  exit {}  wrote: {}".format(host, returncode, ", ".join(written) or "nothing"))
+    print("Outputs in {}".format(work_dir))
+    sys.exit(max(returncode != 0 for _, returncode in results))
+
+
+if __name__ == "__main__":
+    main()
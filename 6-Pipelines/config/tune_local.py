@@ -0,0 +1,211 @@
+"""Local hyperparameter search for the training script xgboost_customer_churn.py.
+
+Searches max_depth, eta, gamma, min_child_weight and subsample on the
+2-Modeling train and validation sets with a pool of worker processes instead of
+one SageMaker training job per trial. The sets are parsed once, before the
+workers are forked, and every worker builds its DMatrix objects from them once
+and reuses them for all of its trials. Trials train with the script's
+hyperparameter defaults, hist and the validation AUC as evaluation metric, and
+the script's EarlyStoppingCallback prunes a trial once the AUC stops improving.
+
+`random` trains --trials random configurations for --num-round rounds each.
+`halving` (successive halving) trains them all for --min-rounds rounds, keeps
+the best 1/--reduction by validation AUC, continues the survivors from their
+boosters to --reduction times the rounds, and so on up to --num-round.
+
+The results go to a CSV with one row per trial, named like the columns of
+sagemaker.analytics.ExperimentAnalytics ("validation:auc - Max" ...), so they
+can be put next to the trials of the lab 2 experiment.
+
+    python tune_local.py --strategy random --trials 40 --num-round 300
+    python tune_local.py --strategy halving --trials 81 --min-rounds 10 --num-round 810
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(PATH))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmark_utils import TRAINING_PARAMS, load_script, print_table
+
+DEFAULT_SCRIPT = os.path.join(PATH, "xgboost_customer_churn.py")
+DATA_DIR = os.path.join(REPO_ROOT, "2-Modeling", "config")
+
+# The script's default hyperparameters; the searched ones are overwritten per trial
+PARAMS = dict(TRAINING_PARAMS, tree_method="hist", eval_metric="auc")
+
+# name: (kind, low, high); "log" samples uniformly on a log scale
+SEARCH_SPACE = {
+    "max_depth": ("int", 2, 10),
+    "eta": ("log", 0.01, 0.5),
+    "gamma": ("float", 0.0, 10.0),
+    "min_child_weight": ("float", 1.0, 10.0),
+    "subsample": ("float", 0.5, 1.0),
+}
+
+# Set in the parent before the workers are forked, and in each worker by _init_worker
+_DATA = {}
+_TRAINING = None
+_DMATRICES = None
+
+
+def sample_configurations(trials, seed):
+    rng = np.random.default_rng(seed)
+    configurations = []
+    for _ in range(trials):
+        configuration = {}
+        for name, (kind, low, high) in SEARCH_SPACE.items():
+            if kind == "int":
+                configuration[name] = int(rng.integers(low, high + 1))
+            elif kind == "log":
+                configuration[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+            else:
+                configuration[name] = float(rng.uniform(low, high))
+        configurations.append(configuration)
+    return configurations
+
+
+def _init_worker(max_bin):
+    global _DMATRICES
+    xgboost = _TRAINING.xgboost
+    features, label = _DATA["train"]
+    dtrain = xgboost.QuantileDMatrix(features, label, max_bin=max_bin)
+    features, label = _DATA["validation"]
+    dval = xgboost.QuantileDMatrix(features, label, max_bin=max_bin, ref=dtrain)
+    _DMATRICES = dtrain, dval
+
+
+def _run_trial(params, rounds, early_stopping_rounds, model=None):
+    """Train `rounds` more rounds, from the raw booster `model` if given; returns the trial's state."""
+    xgboost = _TRAINING.xgboost
+    dtrain, dval = _DMATRICES
+    if model is not None:
+        model = xgboost.Booster(model_file=bytearray(model))
+    target = (model.num_boosted_rounds() if model is not None else 0) + rounds
+    evals_result = {}
+    start = time.perf_counter()
+    bst = xgboost.train(params, dtrain, num_boost_round=rounds, evals=[(dtrain, "train"), (dval, "validation")],
+                        xgb_model=model, evals_result=evals_result, verbose_eval=False,
+                        callbacks=[_TRAINING.EarlyStoppingCallback(early_stopping_rounds)])
+    best_iteration = int(bst.attr("best_iteration"))
+    return {
+        "model": bytes(bst.save_raw("ubj")),
+        "rounds_trained": bst.num_boosted_rounds(),
+        "stopped": bst.num_boosted_rounds() < target,
+        "best_iteration": best_iteration,
+        "validation:auc - Max": float(bst.attr("best_score")),
+        "validation:auc - Last": evals_result["validation"]["auc"][-1],
+        "train:auc - Last": evals_result["train"]["auc"][-1],
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def random_search(pool, configurations, params, num_round, early_stopping_rounds):
+    pending = [pool.apply_async(_run_trial, (dict(params, **c), num_round, early_stopping_rounds))
+               for c in configurations]
+    results = []
+    for configuration, result in zip(configurations, pending):
+        state = result.get()
+        state["status"] = "early-stopped" if state["stopped"] else "completed"
+        results.append((configuration, state))
+    return results
+
+
+def successive_halving(pool, configurations, params, min_rounds, num_round, reduction, early_stopping_rounds):
+    states = [None] * len(configurations)
+    alive = list(range(len(configurations)))
+    rounds = min_rounds
+    while alive:
+        pending = {}
+        for index in alive:
+            state = states[index]
+            done = state["rounds_trained"] if state else 0
+            pending[index] = pool.apply_async(_run_trial, (
+                dict(params, **configurations[index]), rounds - done, early_stopping_rounds,
+                state["model"] if state else None))
+        for index, result in pending.items():
+            seconds = states[index]["seconds"] if states[index] else 0.0
+            states[index] = result.get()
+            states[index]["seconds"] += seconds
+            states[index]["status"] = "early-stopped" if states[index]["stopped"] else "completed"
+        if rounds >= num_round:
+            break
+        # Early-stopped trials cannot improve any more; promote the best of the others
+        candidates = sorted((index for index in alive if not states[index]["stopped"]),
+                            key=lambda index: states[index]["validation:auc - Max"], reverse=True)
+        alive = candidates[:max(1, len(alive) // reduction)] if candidates else []
+        for index in candidates[len(alive):]:
+            states[index]["status"] = "pruned"
+        rounds = min(rounds * reduction, num_round)
+    return list(zip(configurations, states))
+
+
+def results_table(results):
+    rows = []
+    for index, (configuration, state) in enumerate(results):
+        row = {"TrialName": "local-trial-{:03d}".format(index)}
+        row.update(configuration)
+        for column in ["status", "rounds_trained", "best_iteration", "train:auc - Last", "validation:auc - Last",
+                       "validation:auc - Max", "seconds"]:
+            row[column] = state[column]
+        rows.append(row)
+    return sorted(rows, key=lambda row: row["validation:auc - Max"], reverse=True)
+
+
+def main():
+    global _TRAINING
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strategy", choices=["random", "halving"], default="random")
+    parser.add_argument("--script", type=str, default=DEFAULT_SCRIPT)
+    parser.add_argument("--train", type=str, default=os.path.join(DATA_DIR, "train.csv"))
+    parser.add_argument("--validation", type=str, default=os.path.join(DATA_DIR, "validation.csv"))
+    parser.add_argument("--trials", type=int, default=27)
+    parser.add_argument("--num-round", type=int, default=270,
+                        help="Rounds per trial; for halving, the rounds of the last rung.")
+    parser.add_argument("--min-rounds", type=int, default=10,
+                        help="Rounds of the first successive halving rung.")
+    parser.add_argument("--reduction", type=int, default=3,
+                        help="Successive halving keeps 1/reduction of the trials per rung.")
+    parser.add_argument("--early-stopping-rounds", type=int, default=20)
+    parser.add_argument("--max-bin", type=int, default=256)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="tuning-results.csv")
+    args = parser.parse_args()
+
+    _TRAINING = load_script(args.script, "training")
+    for name in ["train", "validation"]:
+        data = np.loadtxt(getattr(args, name), delimiter=",", dtype=np.float32)
+        _DATA[name] = data[:, 1:], data[:, 0]
+
+    # Split the cores between the workers instead of letting every trial use all of them
+    params = dict(PARAMS, max_bin=args.max_bin, seed=args.seed, nthread=max(1, os.cpu_count() // args.jobs))
+    configurations = sample_configurations(args.trials, args.seed)
+    start = time.perf_counter()
+    # fork, so the workers inherit the parsed sets and the loaded script instead of re-reading them
+    with multiprocessing.get_context("fork").Pool(args.jobs, _init_worker, (args.max_bin,)) as pool:
+        if args.strategy == "halving":
+            results = successive_halving(pool, configurations, params, args.min_rounds, args.num_round,
+                                         args.reduction, args.early_stopping_rounds)
+        else:
+            results = random_search(pool, configurations, params, args.num_round, args.early_stopping_rounds)
+    rows = results_table(results)
+
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print_table(rows)
+    print("{} trials, {} boosting rounds in {:.1f}s; results in {}".format(
+        len(rows), sum(row["rounds_trained"] for row in rows), time.perf_counter() - start, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Check that a killed and resumed training job produces the uninterrupted model.
+
+Runs xgboost_customer_churn.py three times on the 2-Modeling train and
+validation sets, all with --checkpoint_frequency:
+
+1. uninterrupted, as the reference;
+2. killed with SIGKILL as soon as a checkpoint past --kill-after rounds is
+   on disk. A damaged checkpoint newer than every real one is then planted,
+   as a torn upload would leave it;
+3. restarted on the checkpoint directory of run 2.
+
+The resumed model must be byte-for-byte the reference model, and no more
+than --checkpoint-keep checkpoints may be left behind. Unknown arguments are
+passed to the training script as hyperparameters.
+
+    python verify_checkpoint_resume.py --num-round 300 --checkpoint-frequency 10
+"""
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(PATH))
+
+DEFAULT_SCRIPT = os.path.join(PATH, "xgboost_customer_churn.py")
+DATA_DIR = os.path.join(REPO_ROOT, "2-Modeling", "config")
+
+
+def make_channels(work_dir):
+    channels = {}
+    for name in ["train", "validation"]:
+        channels[name] = os.path.join(work_dir, name)
+        os.makedirs(channels[name])
+        shutil.copy(os.path.join(DATA_DIR, name + ".csv"), channels[name])
+    return channels
+
+
+def start_training(args, channels, run_dir, hyperparameters):
+    env = dict(os.environ, SM_MODEL_DIR=os.path.join(run_dir, "model"))
+    command = [sys.executable, args.script,
+               "--train", channels["train"], "--validation", channels["validation"],
+               "--output_uri", os.path.join(run_dir, "tensors"),
+               "--num_round", str(args.num_round),
+               "--checkpoint_frequency", str(args.checkpoint_frequency),
+               "--checkpoint_keep", str(args.checkpoint_keep),
+               "--checkpoint_dir", os.path.join(run_dir, "checkpoints")] + hyperparameters
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+
+
+def checkpoint_rounds(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    return sorted(int(file[len("checkpoint-"):-len(".ubj")]) for file in os.listdir(checkpoint_dir)
+                  if file.startswith("checkpoint-") and file.endswith(".ubj"))
+
+
+def kill_after(process, checkpoint_dir, rounds):
+    """SIGKILL `process` once a checkpoint of at least `rounds` rounds exists; returns the checkpoints left."""
+    while process.poll() is None:
+        if any(r >= rounds for r in checkpoint_rounds(checkpoint_dir)):
+            process.send_signal(signal.SIGKILL)
+            process.wait()
+            break
+        time.sleep(0.005)
+    if process.returncode != -signal.SIGKILL:
+        raise RuntimeError("Training finished before it could be killed, raise --num-round")
+    return checkpoint_rounds(checkpoint_dir)
+
+
+def read_model(run_dir):
+    with open(os.path.join(run_dir, "model", "xgboost-model"), "rb") as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", type=str, default=DEFAULT_SCRIPT)
+    parser.add_argument("--num-round", type=int, default=300)
+    parser.add_argument("--checkpoint-frequency", type=int, default=10)
+    parser.add_argument("--checkpoint-keep", type=int, default=3)
+    parser.add_argument("--kill-after", type=int, default=None,
+                        help="Rounds checkpointed before the kill, half of --num-round if unset.")
+    args, hyperparameters = parser.parse_known_args()
+
+    work_dir = tempfile.mkdtemp(prefix="verify-checkpoint-")
+    try:
+        channels = make_channels(work_dir)
+        reference_dir = os.path.join(work_dir, "reference")
+        if start_training(args, channels, reference_dir, hyperparameters).wait() != 0:
+            raise RuntimeError("The reference run failed")
+
+        resumed_dir = os.path.join(work_dir, "resumed")
+        checkpoint_dir = os.path.join(resumed_dir, "checkpoints")
+        left = kill_after(start_training(args, channels, resumed_dir, hyperparameters), checkpoint_dir,
+                          args.kill_after or args.num_round // 2)
+        print("Killed with checkpoints of rounds {} on disk".format(left))
+        damaged = os.path.join(checkpoint_dir, "checkpoint-{:06d}.ubj".format(left[-1] + args.checkpoint_frequency))
+        with open(damaged, "wb") as f:
+            f.write(b"{torn")
+
+        if start_training(args, channels, resumed_dir, hyperparameters).wait() != 0:
+            raise RuntimeError("The resumed run failed")
+        left = checkpoint_rounds(checkpoint_dir)
+        same = read_model(reference_dir) == read_model(resumed_dir)
+        print("Checkpoints left: {} (keep {})".format(left, args.checkpoint_keep))
+        print("Resumed model identical to the uninterrupted one: {}".format(same))
+        sys.exit(0 if same and len(left) <= args.checkpoint_keep else 1)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
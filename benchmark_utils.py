@@ -0,0 +1,59 @@
+"""Helpers shared by the local benchmark, tuning and evaluation scripts of the labs.
+
+The scripts sit next to the code they exercise, in the config directory of each
+lab, and put the repository root on sys.path to import this module.
+"""
+import importlib.util
+import os
+import sys
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_TRAIN = os.path.join(REPO_ROOT, "2-Modeling", "config", "train.csv")
+
+# The training script's default hyperparameters
+TRAINING_PARAMS = {"max_depth": 5, "eta": 0.2, "gamma": 4, "min_child_weight": 6, "subsample": 0.8,
+                   "objective": "binary:logistic", "verbosity": 0}
+
+
+def load_script(script_path, name):
+    """
+    Import the script at `script_path` as module `name`. The module is registered in sys.modules,
+    so pool workers can unpickle the functions it defines by name.
+    """
+    spec = importlib.util.spec_from_file_location(name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_handler(script_path):
+    return load_script(script_path, "handler")
+
+
+def train_model(model_dir, train_path=DEFAULT_TRAIN, num_round=50):
+    """Train a small booster on the workshop dataset when no artifact is given."""
+    # Imported here, as the preprocessing benchmarks run without XGBoost
+    import xgboost
+    data = np.loadtxt(train_path, delimiter=",")
+    dtrain = xgboost.DMatrix(data[:, 1:], label=data[:, 0])
+    bst = xgboost.train(TRAINING_PARAMS, dtrain, num_boost_round=num_round)
+    os.makedirs(model_dir, exist_ok=True)
+    bst.save_model(os.path.join(model_dir, "xgboost-model"))
+    return model_dir
+
+
+def read_rows(rows_path):
+    with open(rows_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def print_table(results):
+    columns = list(results[0].keys())
+    print(" | ".join("{:>16}".format(c) for c in columns))
+    for result in results:
+        print(" | ".join("{:>16.4g}".format(result[c]) if isinstance(result[c], float)
+                         else "{:>16}".format(str(result[c])) for c in columns))
@@ -0,0 +1,342 @@
+"""Serve any handler script in the workshop locally and load-test it.
+
+The server implements the SageMaker hosting contract (GET /ping and
+POST /invocations) on top of the handler's model_fn/input_fn/predict_fn/output_fn,
+with one pre-forked process per worker, so a handler can be exercised without
+deploying an endpoint. Handlers that only define model_fn get the XGBoost
+container's CSV defaults for the other functions.
+
+    python local_serving.py serve --handler 4-Deployment/RealTime/config/xgboost_customer_churn.py \\
+        --model-dir /path/to/extracted/model --workers 2
+    python local_serving.py bench --handler 5-Monitoring/config/inference.py \\
+        --model-dir /path/to/extracted/model --workers 2 --concurrency 8 --output results.jsonl
+
+`bench` appends one JSON line per run to --output with throughput,
+p50/p95/p99 latency and the RSS of every worker, so runs against different
+handler versions can be compared. Forking workers and reading RSS from /proc
+make this Linux only, like the SageMaker containers themselves.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+import xgboost
+
+from benchmark_utils import load_handler
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_ROWS = os.path.join(PATH, "1-DataPrep", "config", "test-dataset.csv")
+
+
+def default_input_fn(request_body, content_type):
+    if content_type != "text/csv":
+        raise ValueError("Content type {} is not supported.".format(content_type))
+    return xgboost.DMatrix(np.loadtxt(BytesIO(request_body), delimiter=",", dtype=np.float32, ndmin=2))
+
+
+def default_predict_fn(input_object, model):
+    # The container's default model_fn, and some copies of it, return (booster, format)
+    if isinstance(model, tuple):
+        model = model[0]
+    return model.predict(input_object)
+
+
+def default_output_fn(prediction, accept):
+    if accept != "text/csv":
+        raise ValueError("Content type {} is not supported.".format(accept))
+    return "\n".join(map(str, np.ravel(prediction).tolist()))
+
+
+class InvocationsHandler(BaseHTTPRequestHandler):
+    """HTTP front end for one worker's handler module and model."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    handler = None
+    model = None
+
+    def do_GET(self):
+        if self.path == "/ping":
+            self._respond(200, b"", "text/plain")
+        else:
+            self._respond(404, b"Not found", "text/plain")
+
+    def do_POST(self):
+        if self.path != "/invocations":
+            self._respond(404, b"Not found", "text/plain")
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type = self.headers.get("Content-Type", "text/csv")
+        accept = self.headers.get("Accept")
+        if not accept or accept == "*/*":
+            accept = content_type
+
+        handler = self.handler
+        try:
+            data = getattr(handler, "input_fn", default_input_fn)(body, content_type)
+            prediction = getattr(handler, "predict_fn", default_predict_fn)(data, self.model)
+            response = getattr(handler, "output_fn", default_output_fn)(prediction, accept)
+        except ValueError as e:
+            self._respond(400, str(e).encode("utf-8"), "text/plain")
+            return
+        except Exception as e:
+            self._respond(500, str(e).encode("utf-8"), "text/plain")
+            return
+
+        if isinstance(response, tuple):
+            response, accept = response
+        if isinstance(response, str):
+            response = response.encode("utf-8")
+        self._respond(200, response, accept)
+
+    def _respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _run_worker(server, handler_path, model_dir, log_path):
+    if log_path is not None:
+        log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        os.dup2(log, sys.stdout.fileno())
+        os.dup2(log, sys.stderr.fileno())
+    handler = load_handler(handler_path)
+    InvocationsHandler.handler = handler
+    InvocationsHandler.model = handler.model_fn(model_dir)
+    signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+    server.serve_forever()
+
+
+def start_workers(handler_path, model_dir, port, workers, host="127.0.0.1", log_path=None):
+    """Bind the listening socket once, then fork `workers` processes that all accept on it."""
+    server = ThreadingHTTPServer((host, port), InvocationsHandler)
+    server.daemon_threads = True
+    pids = []
+    for _ in range(workers):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(server, handler_path, model_dir, log_path)
+            finally:
+                os._exit(1)
+        pids.append(pid)
+    server.socket.close()
+    return pids
+
+
+def stop_workers(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def wait_until_ready(host, port, pids, timeout=120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for pid in pids:
+            if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                raise RuntimeError("Worker {} exited during start-up".format(pid))
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=1)
+            connection.request("GET", "/ping")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Workers did not answer /ping within {} seconds".format(timeout))
+
+
+def read_rows(rows_path, label_column=None):
+    """Read CSV rows as bytes, dropping the label column when the file has one."""
+    rows = []
+    with open(rows_path, "rb") as f:
+        for line in f:
+            fields = line.strip().split(b",")
+            if fields == [b""]:
+                continue
+            if label_column is not None:
+                del fields[label_column]
+            rows.append(b",".join(fields))
+    return rows
+
+
+def make_payloads(rows, batch_size, count, seed=0):
+    """Sample `count` request bodies of `batch_size` random rows each."""
+    rng = random.Random(seed)
+    return [b"\n".join(rng.choice(rows) for _ in range(batch_size)) for _ in range(count)]
+
+
+def run_load(host, port, payloads, concurrency, duration, content_type="text/csv"):
+    """Closed-loop load: each client thread keeps one connection and sends requests back to back."""
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    stop = threading.Event()
+
+    def client(i):
+        connection = http.client.HTTPConnection(host, port)
+        n = i
+        while not stop.is_set():
+            payload = payloads[n % len(payloads)]
+            n += concurrency
+            start = time.perf_counter()
+            try:
+                connection.request("POST", "/invocations", body=payload,
+                                   headers={"Content-Type": content_type, "Accept": content_type})
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(host, port)
+                ok = False
+            if ok:
+                latencies[i].append(time.perf_counter() - start)
+            else:
+                errors[i] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return np.concatenate([np.array(c, dtype=np.float64) for c in latencies]), sum(errors), elapsed
+
+
+def process_memory(pid):
+    """Current and peak resident set size of a process in MB, read from /proc."""
+    memory = {}
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                memory[key] = int(value.split()[0]) / 1024
+    return {"rss_mb": memory.get("VmRSS"), "peak_rss_mb": memory.get("VmHWM")}
+
+
+def git_revision(path):
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=path,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench(args):
+    handler_path = os.path.abspath(args.handler)
+    label_column = None if args.label_column < 0 else args.label_column
+    payloads = make_payloads(read_rows(args.rows, label_column), args.batch_size, args.payloads)
+
+    pids = start_workers(handler_path, args.model_dir, args.port, args.workers, args.host, args.worker_log)
+    try:
+        wait_until_ready(args.host, args.port, pids)
+        if args.warmup > 0:
+            run_load(args.host, args.port, payloads, args.concurrency, args.warmup)
+        latencies, errors, elapsed = run_load(args.host, args.port, payloads, args.concurrency, args.duration)
+        workers = [dict({"pid": pid}, **process_memory(pid)) for pid in pids]
+    finally:
+        stop_workers(pids)
+
+    latency_ms = 1000 * latencies if len(latencies) else np.zeros(1)
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "handler": os.path.relpath(handler_path, PATH),
+        "git_revision": git_revision(os.path.dirname(handler_path)),
+        "workers": args.workers,
+        "concurrency": args.concurrency,
+        "batch_size": args.batch_size,
+        "duration_s": elapsed,
+        "requests": int(len(latencies)),
+        "errors": errors,
+        "requests_per_sec": len(latencies) / elapsed,
+        "rows_per_sec": len(latencies) * args.batch_size / elapsed,
+        "latency_ms": {
+            "mean": float(np.mean(latency_ms)),
+            "p50": float(np.percentile(latency_ms, 50)),
+            "p95": float(np.percentile(latency_ms, 95)),
+            "p99": float(np.percentile(latency_ms, 99)),
+        },
+        "worker_memory": workers,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+def serve(args):
+    pids = start_workers(os.path.abspath(args.handler), args.model_dir, args.port, args.workers, args.host)
+    print("Serving {} on http://{}:{} with workers {}".format(args.handler, args.host, args.port, pids))
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except (KeyboardInterrupt, SystemExit):
+        stop_workers(pids)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--handler", type=str, required=True, help="Handler script to serve.")
+    common.add_argument("--model-dir", type=str, required=True, help="Directory with the extracted model.tar.gz.")
+    common.add_argument("--workers", type=int, default=1)
+    common.add_argument("--host", type=str, default="127.0.0.1")
+    common.add_argument("--port", type=int, default=8080)
+
+    subparsers.add_parser("serve", parents=[common])
+
+    bench_parser = subparsers.add_parser("bench", parents=[common])
+    bench_parser.add_argument("--rows", type=str, default=DEFAULT_ROWS)
+    bench_parser.add_argument("--label-column", type=int, default=0,
+                              help="Column to drop from --rows before sending them, -1 to keep every column.")
+    bench_parser.add_argument("--batch-size", type=int, default=1, help="Rows per request.")
+    bench_parser.add_argument("--payloads", type=int, default=1000, help="Distinct request bodies to cycle through.")
+    bench_parser.add_argument("--concurrency", type=int, default=4)
+    bench_parser.add_argument("--duration", type=float, default=10.0)
+    bench_parser.add_argument("--warmup", type=float, default=1.0, help="Seconds of load before measuring.")
+    bench_parser.add_argument("--output", type=str, default=None, help="JSON Lines file the result is appended to.")
+    bench_parser.add_argument("--worker-log", type=str, default=os.devnull,
+                              help="File the workers' stdout and stderr go to.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "serve":
+        serve(args)
+    else:
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()